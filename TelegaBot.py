@@ -1,537 +1,2745 @@
-import os
-import logging
-import json
-import psycopg2
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    CallbackQueryHandler,
-    MessageHandler,
-    ContextTypes,
-    ConversationHandler,
-    filters
-)
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-(
-    MAIN_MENU,
-    EDIT_PROFILE,
-    SELECT_INSTRUMENTS,
-    SELECT_SEEKING,
-    WRITE_BIO,
-    BROWSE_MODE,
-    BROWSE_PROFILES
-) = range(7)
-
-INSTRUMENTS = [
-    "vocalist", "guitarist", "drummer", "cajon player",
-    "sound engineer", "pianist", "bassist", "violinist",
-    "other instrument", "other (non-instrumental)"
-]
-
-HELP_TEXT = """
-🎵 *Acoustic Night Collaboration Bot Help* 🎵
-
-*Main Features:*
-1. ✏️ Edit Profile - Set up your instruments and preferences
-2. 🔍 Find Collaborators - Two search modes:
-   - 🎯 Smart Matches: Based on mutual preferences
-   - 🔀 Browse All: Discover all musicians
-3. 👤 My Profile - View your current profile details
-4. 🎶 My Matches - View mutual connections
-5. ❓ Help - Show this information
-
-*Profile Requirements:*
-- At least 1 instrument selected
-- Specify what you're seeking
-- Short bio (120 characters max)
-
-Need help? Contact @znashh
-"""
-
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write(b'OK')
-
-def run_health_check_server():
-    port = int(os.getenv('PORT', 10000))
-    server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
-    logger.info(f"Health check server running on port {port}")
-    server.serve_forever()
-
-class Database:
-    def __init__(self):
-        self.conn = psycopg2.connect(os.getenv("DATABASE_URL"))
-        self.create_tables()
-
-    def create_tables(self):
-        with self.conn.cursor() as cur:
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id TEXT PRIMARY KEY,
-                    data JSONB NOT NULL
-                )
-            """)
-            self.conn.commit()
-
-    def get_user(self, user_id):
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT data FROM users WHERE user_id = %s", (user_id,))
-                result = cur.fetchone()
-                if result:
-                    return json.loads(result[0]) if isinstance(result[0], str) else result[0]
-                return None
-        except Exception as e:
-            logger.error(f"Database error in get_user: {str(e)}")
-            return None
-
-    def save_user(self, user_id, data):
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO users (user_id, data)
-                    VALUES (%s, %s)
-                    ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data
-                """, (user_id, json.dumps(data, default=str)))
-                self.conn.commit()
-        except Exception as e:
-            logger.error(f"Database error in save_user: {str(e)}")
-
-    def get_all_users(self):
-        try:
-            with self.conn.cursor() as cur:
-                cur.execute("SELECT data FROM users")
-                return [json.loads(row[0]) if isinstance(row[0], str) else row[0] for row in cur.fetchall()]
-        except Exception as e:
-            logger.error(f"Database error in get_all_users: {str(e)}")
-            return []
-
-class AcousticMatchBot:
-    def __init__(self):
-        self.db = Database()
-        
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user = update.effective_user
-        user_id = str(user.id)
-        
-        user_data = self.db.get_user(user_id) or {
-            "user_id": user_id,
-            "name": user.full_name,
-            "username": user.username,
-            "instruments": [],
-            "seeking": [],
-            "bio": "",
-            "likes": [],
-            "matches": [],
-            "pending": [],
-            "viewed": [],
-            "created_at": datetime.now().isoformat()
-        }
-        
-        user_data.update({
-            "name": user.full_name,
-            "username": user.username
-        })
-        
-        self.db.save_user(user_id, user_data)
-        return await self.main_menu(update, context)
-
-    async def main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        keyboard = [
-            [InlineKeyboardButton("✏️ Edit Profile", callback_data="edit_profile")],
-            [InlineKeyboardButton("🔍 Find Collaborators", callback_data="browse_mode")],
-            [InlineKeyboardButton("👤 My Profile", callback_data="my_profile")],
-            [InlineKeyboardButton("🎶 My Matches", callback_data="my_matches")],
-            [InlineKeyboardButton("❓ Help", callback_data="help")]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        if update.message:
-            await update.message.reply_text("🎸🎶 Hey there! This is Acoustic Night bot for collaborations! Click Help to find out more! 🌟:", reply_markup=reply_markup)
-        else:
-            await update.callback_query.edit_message_text("🎸🎶 Hey there! This is Acoustic Night bot for collaborations! Click Help to find out more! 🌟:", reply_markup=reply_markup)
-        return MAIN_MENU
-
-    async def show_my_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        user_id = str(query.from_user.id)
-        user_data = self.db.get_user(user_id)
-        
-        profile_text = (
-            "👤 *Your Profile*\n\n"
-            f"🎻 Instruments: {', '.join(user_data['instruments']) or '-'}\n"
-            f"🔍 Seeking: {', '.join(user_data['seeking']) or '-'}\n"
-            f"📝 Bio: {user_data['bio'] or '-'}"
-        )
-        
-        await query.edit_message_text(
-            profile_text,
-            parse_mode="Markdown",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="back")]])
-        )
-        return MAIN_MENU
-
-    async def edit_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        await query.answer()
-        
-        keyboard = [
-            [InlineKeyboardButton("🎻 My Instruments", callback_data="edit_instruments")],
-            [InlineKeyboardButton("🔍 Seeking", callback_data="edit_seeking")],
-            [InlineKeyboardButton("📝 Bio", callback_data="edit_bio")],
-            [InlineKeyboardButton("🔙 Back", callback_data="back")]
-        ]
-        
-        await query.edit_message_text(
-            "✏️ Edit Profile:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return EDIT_PROFILE
-
-    async def select_category(self, update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):
-        query = update.callback_query
-        await query.answer()
-        user_id = str(query.from_user.id)
-        user_data = self.db.get_user(user_id)
-        
-        current_selection = user_data[category]
-        keyboard = []
-        
-        for instr in INSTRUMENTS:
-            status = "✅" if instr in current_selection else "◻️"
-            keyboard.append([InlineKeyboardButton(
-                f"{status} {instr.title()}",
-                callback_data=f"toggle_{category}_{instr}"
-            )])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
-        
-        await query.edit_message_text(
-            f"Select your {category.replace('_', ' ')}:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return SELECT_INSTRUMENTS if category == "instruments" else SELECT_SEEKING
-
-    async def handle_toggle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        user_id = str(query.from_user.id)
-        _, category, instrument = query.data.split("_", 2)
-        
-        user_data = self.db.get_user(user_id)
-        if instrument in user_data[category]:
-            user_data[category].remove(instrument)
-        else:
-            user_data[category].append(instrument)
-        
-        self.db.save_user(user_id, user_data)
-        return await self.select_category(update, context, category)
-
-    async def request_bio(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        await query.answer()
-        await query.edit_message_text(
-            "📝 Please write a short bio (max 120 characters):\n\n"
-            "Example:\n"
-            "\"Guitarist looking for vocalist to create acoustic covers. "
-            "Available weekends. Love rock and pop!\""
-        )
-        return WRITE_BIO
-
-    async def save_bio(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = str(update.effective_user.id)
-        bio = update.message.text
-        
-        if len(bio) > 120:
-            await update.message.reply_text("❌ Bio is too long! Maximum 120 characters.")
-            return WRITE_BIO
-            
-        user_data = self.db.get_user(user_id)
-        user_data["bio"] = bio
-        self.db.save_user(user_id, user_data)
-        await update.message.reply_text("✅ Bio saved successfully!")
-        return await self.main_menu(update, context)
-
-    async def browse_mode(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        await query.answer()
-        
-        all_users = self.db.get_all_users()
-        if len(all_users) <= 1:
-            await query.edit_message_text("😢 No other profiles available yet!")
-            return await self.main_menu(update, context)
-        
-        keyboard = [
-            [InlineKeyboardButton("🎯 Smart Matches", callback_data="smart")],
-            [InlineKeyboardButton("🔀 Browse All", callback_data="all")],
-            [InlineKeyboardButton("🔙 Back", callback_data="back")]
-        ]
-        
-        await query.edit_message_text(
-            "🔍 Choose browsing mode:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return BROWSE_MODE
-
-    async def prepare_browsing(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        await query.answer()
-        user_id = str(query.from_user.id)
-        mode = query.data
-        current_user = self.db.get_user(user_id)
-        all_users = self.db.get_all_users()
-        
-        candidates = []
-        for user in all_users:
-            if user["user_id"] == user_id:
-                continue
-                
-            if mode == "smart":
-                instrument_match = any(instr in user["instruments"] for instr in current_user["seeking"])
-                seeking_match = any(instr in current_user["instruments"] for instr in user["seeking"])
-                if instrument_match and seeking_match:
-                    candidates.append(user)
-            else:
-                if user["user_id"] not in current_user["pending"]:
-                    candidates.append(user)
-        
-        if not candidates:
-            await query.edit_message_text("😢 No matching profiles found!")
-            return await self.main_menu(update, context)
-        
-        context.user_data["candidates"] = candidates
-        context.user_data["current_index"] = 0
-        return await self.show_profile(update, context)
-
-    async def show_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        user_id = str(update.effective_user.id)
-        candidates = context.user_data["candidates"]
-        index = context.user_data["current_index"]
-        current_user = self.db.get_user(user_id)
-        
-        if index >= len(candidates):
-            await update.callback_query.edit_message_text("🏁 You've viewed all profiles!")
-            return await self.main_menu(update, context)
-        
-        profile = candidates[index]
-        is_match = profile["user_id"] in current_user["matches"]
-        contact = f"@{profile['username']}" if (is_match and profile.get("username")) else "🔒 Contact hidden until mutual match"
-
-        keyboard = []
-        if index > 0:
-            keyboard.append([InlineKeyboardButton("⬅️ Previous", callback_data="previous")])
-        
-        if not is_match:
-            keyboard.append([
-                InlineKeyboardButton("🎵 Let's Collab", callback_data="like"),
-                InlineKeyboardButton("➡️ Next", callback_data="next")
-            ])
-        else:
-            keyboard.append([InlineKeyboardButton("➡️ Next", callback_data="next")])
-        
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
-        
-        text = (
-            f"🎸 Profile {index+1}/{len(candidates)}\n\n"
-            f"👤 Name: {profile['name']}\n"
-            f"📞 Contact: {contact}\n"
-            f"🎻 Instruments: {', '.join(profile['instruments'])}\n"
-            f"🔍 Seeking: {', '.join(profile['seeking'])}\n"
-            f"📝 Bio: {profile['bio']}"
-        )
-        
-        await update.callback_query.edit_message_text(
-            text,
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return BROWSE_PROFILES
-
-    async def handle_navigation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        action = query.data
-        
-        if action == "previous":
-            context.user_data["current_index"] -= 1
-        elif action == "next":
-            context.user_data["current_index"] += 1
-        
-        return await self.show_profile(update, context)
-
-    async def handle_like(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        user_id = str(query.from_user.id)
-        current_user = self.db.get_user(user_id)
-        profile = context.user_data["candidates"][context.user_data["current_index"]]
-        target_id = profile["user_id"]
-        
-        if target_id in current_user["pending"]:
-            await query.answer("Request already pending!")
-            return BROWSE_PROFILES
-            
-        current_user["pending"].append(target_id)
-        self.db.save_user(user_id, current_user)
-        
-        keyboard = [
-            [InlineKeyboardButton("✅ Accept", callback_data=f"accept_{user_id}"),
-             InlineKeyboardButton("❌ Decline", callback_data=f"decline_{user_id}")]
-        ]
-        await context.bot.send_message(
-            chat_id=target_id,
-            text=f"🎵 New collaboration request from {current_user['name']}!\n\n"
-                 f"View their profile and respond:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        
-        await query.answer("Request sent!")
-        context.user_data["current_index"] += 1
-        return await self.show_profile(update, context)
-
-    async def handle_response(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        user_id = str(query.from_user.id)
-        action, sender_id = query.data.split("_")
-        
-        current_user = self.db.get_user(user_id)
-        sender_data = self.db.get_user(sender_id)
-        
-        if sender_id in current_user["pending"]:
-            current_user["pending"].remove(sender_id)
-        
-        if action == "accept":
-            current_user["matches"].append(sender_id)
-            sender_data["matches"].append(user_id)
-            
-            contact = f"@{sender_data['username']}" if sender_data.get("username") else "⚠️ No username set"
-            text = (
-                f"🎉 New Collaboration Partner!\n\n"
-                f"👤 Name: {sender_data['name']}\n"
-                f"📞 Contact: {contact}\n"
-                f"🎻 Instruments: {', '.join(sender_data['instruments'])}\n"
-                f"🔍 Seeking: {', '.join(sender_data['seeking'])}\n"
-                f"📝 Bio: {sender_data['bio']}"
-            )
-            await query.edit_message_text(text)
-            await query.answer("Match accepted!")
-        else:
-            await query.answer("Request declined")
-            await query.message.delete()
-        
-        self.db.save_user(user_id, current_user)
-        self.db.save_user(sender_id, sender_data)
-        return MAIN_MENU
-
-    async def show_matches(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        user_id = str(query.from_user.id)
-        current_user = self.db.get_user(user_id)
-        all_users = self.db.get_all_users()
-        
-        matches = current_user["matches"]
-        smart_matches = [
-            u["user_id"] for u in all_users
-            if u["user_id"] != user_id and
-            any(instr in u["instruments"] for instr in current_user["seeking"]) and
-            any(instr in current_user["instruments"] for instr in u["seeking"])
-        ]
-        
-        all_matches = list(set(matches + smart_matches))
-        
-        if not all_matches:
-            await query.answer("You have no matches yet 😢")
-            return MAIN_MENU
-        
-        matches_text = "🎶 Your Matches:\n\n"
-        for match_id in all_matches:
-            match = self.db.get_user(match_id)
-            contact = f"@{match['username']}" if match.get("username") else "⚠️ No username set"
-            matches_text += (
-                f"👤 {match.get('name', 'Anonymous')}\n"
-                f"🎻 Instruments: {', '.join(match.get('instruments', []))}\n"
-                f"📞 Contact: {contact}\n\n"
-            )
-        
-        await query.message.reply_text(matches_text)
-        return MAIN_MENU
-
-    async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        query = update.callback_query
-        await query.message.reply_text(
-            HELP_TEXT,
-            parse_mode="Markdown",
-            disable_web_page_preview=True
-        )
-        return await self.main_menu(update, context)
-
-def main():
-    # Запуск health check сервера
-    health_check_thread = threading.Thread(target=run_health_check_server, daemon=True)
-    health_check_thread.start()
-
-    # Инициализация бота
-    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    application = Application.builder().token(bot_token).build()
-    bot = AcousticMatchBot()
-
-    # Регистрация обработчиков
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("start", bot.start)],
-        states={
-            MAIN_MENU: [
-                CallbackQueryHandler(bot.edit_profile, pattern="^edit_profile$"),
-                CallbackQueryHandler(bot.browse_mode, pattern="^browse_mode$"),
-                CallbackQueryHandler(bot.show_my_profile, pattern="^my_profile$"),
-                CallbackQueryHandler(bot.show_matches, pattern="^my_matches$"),
-                CallbackQueryHandler(bot.help, pattern="^help$"),
-                CallbackQueryHandler(bot.main_menu, pattern="^back$")
-            ],
-            EDIT_PROFILE: [
-                CallbackQueryHandler(lambda u,c: bot.select_category(u, c, "instruments"), pattern="^edit_instruments$"),
-                CallbackQueryHandler(lambda u,c: bot.select_category(u, c, "seeking"), pattern="^edit_seeking$"),
-                CallbackQueryHandler(bot.request_bio, pattern="^edit_bio$"),
-                CallbackQueryHandler(bot.main_menu, pattern="^back$")
-            ],
-            SELECT_INSTRUMENTS: [
-                CallbackQueryHandler(bot.handle_toggle, pattern=r"^toggle_instruments_"),
-                CallbackQueryHandler(bot.edit_profile, pattern="^back$")
-            ],
-            SELECT_SEEKING: [
-                CallbackQueryHandler(bot.handle_toggle, pattern=r"^toggle_seeking_"),
-                CallbackQueryHandler(bot.edit_profile, pattern="^back$")
-            ],
-            WRITE_BIO: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.save_bio)
-            ],
-            BROWSE_MODE: [
-                CallbackQueryHandler(bot.prepare_browsing),
-                CallbackQueryHandler(bot.main_menu, pattern="^back$")
-            ],
-            BROWSE_PROFILES: [
-                CallbackQueryHandler(bot.handle_navigation, pattern="^(previous|next)$"),
-                CallbackQueryHandler(bot.handle_like, pattern="^like$"),
-                CallbackQueryHandler(bot.main_menu, pattern="^back$")
-            ]
-        },
-        fallbacks=[CommandHandler("start", bot.start)],
-        per_message=False
-    )
-
-    application.add_handler(conv_handler)
-    application.add_handler(CallbackQueryHandler(bot.handle_response, pattern=r"^(accept|decline)_"))
-    
-    # Запуск бота
-    application.run_polling()
-
-if __name__ == "__main__":
-    main()
+import os
+import sys
+import argparse
+import logging
+import json
+import time
+import copy
+import asyncio
+import hmac
+import random
+import cProfile
+import contextlib
+import contextvars
+import bisect
+import functools
+import signal
+import tempfile
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from http import HTTPStatus
+from collections import defaultdict, deque, OrderedDict
+from datetime import datetime
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import (
+    Application,
+    BasePersistence,
+    CommandHandler,
+    CallbackQueryHandler,
+    MessageHandler,
+    ContextTypes,
+    ConversationHandler,
+    PersistenceInput,
+    TypeHandler,
+    filters
+)
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+(
+    MAIN_MENU,
+    EDIT_PROFILE,
+    SELECT_INSTRUMENTS,
+    SELECT_SEEKING,
+    WRITE_BIO,
+    BROWSE_MODE,
+    BROWSE_PROFILES,
+    SEARCH_QUERY
+) = range(8)
+
+INSTRUMENTS = [
+    "vocalist", "guitarist", "drummer", "cajon player",
+    "sound engineer", "pianist", "bassist", "violinist",
+    "other instrument", "other (non-instrumental)"
+]
+
+SEARCH_CONFIG = os.getenv("SEARCH_CONFIG", "english")
+
+MATCHES_PAGE_SIZE = int(os.getenv("MATCHES_PAGE_SIZE", 5))
+BROWSE_WINDOW = int(os.getenv("BROWSE_WINDOW", 20))
+BROWSE_PREFETCH = int(os.getenv("BROWSE_PREFETCH", 3))
+SMART_MATCH_LIMIT = int(os.getenv("SMART_MATCH_LIMIT", 100))
+
+DB_RECONNECT_ATTEMPTS = int(os.getenv("DB_RECONNECT_ATTEMPTS", 2))
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", 500))
+ITER_BATCH_SIZE = int(os.getenv("ITER_BATCH_SIZE", 1000))
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 1000))
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", 300))
+
+PROFILE_CATEGORIES = ("instruments", "seeking")
+EDGE_KINDS = ("like", "pending", "match", "viewed")
+
+HTTP_MAX_BODY = int(os.getenv("HTTP_MAX_BODY", 1024 * 1024))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", 10))
+HEALTH_DB_TIMEOUT = float(os.getenv("HEALTH_DB_TIMEOUT", 2))
+
+READ_REPLICA_URLS = [url.strip() for url in os.getenv("READ_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 5))
+READ_YOUR_WRITES_WINDOW = float(os.getenv("READ_YOUR_WRITES_WINDOW", REPLICA_MAX_LAG))
+
+NOTIFY_QUEUE_SIZE = int(os.getenv("NOTIFY_QUEUE_SIZE", 1000))
+NOTIFY_WORKERS = int(os.getenv("NOTIFY_WORKERS", 4))
+NOTIFY_GLOBAL_RATE = float(os.getenv("NOTIFY_GLOBAL_RATE", 25))
+NOTIFY_CHAT_RATE = float(os.getenv("NOTIFY_CHAT_RATE", 1))
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", 5))
+NOTIFY_BACKOFF = float(os.getenv("NOTIFY_BACKOFF", 1))
+NOTIFY_SWEEP_INTERVAL = float(os.getenv("NOTIFY_SWEEP_INTERVAL", 30))
+NOTIFY_CLAIM_LEASE = float(os.getenv("NOTIFY_CLAIM_LEASE", NOTIFY_SWEEP_INTERVAL * 4))
+
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 1))
+
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 1))
+PERSISTENCE_FLUSH_DELAY = float(os.getenv("PERSISTENCE_FLUSH_DELAY", 0.2))
+
+PROFILE_EDIT_RENDER_INTERVAL = float(os.getenv("PROFILE_EDIT_RENDER_INTERVAL", 0.5))
+PROFILE_EDIT_FLUSH_DELAY = float(os.getenv("PROFILE_EDIT_FLUSH_DELAY", 30))
+PROFILE_EDIT_RECOVER_AGE = float(os.getenv("PROFILE_EDIT_RECOVER_AGE", PROFILE_EDIT_FLUSH_DELAY * 2))
+
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 500))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0.1))
+PROFILE_DIR = os.getenv("PROFILE_DIR", ".")
+ADMIN_IDS = {int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP_TEXT = """
+🎵 *Acoustic Night Collaboration Bot Help* 🎵
+
+*Main Features:*
+1. ✏️ Edit Profile - Set up your instruments and preferences
+2. 🔍 Find Collaborators - Three search modes:
+   - 🎯 Smart Matches: Based on mutual preferences
+   - 🔀 Browse All: Discover all musicians
+   - 🔎 Search: Find musicians by name, instrument or bio (/search fingerstyle jazz)
+3. 👤 My Profile - View your current profile details
+4. 🎶 My Matches - View mutual connections
+5. ❓ Help - Show this information
+
+*Profile Requirements:*
+- At least 1 instrument selected
+- Specify what you're seeking
+- Short bio (120 characters max)
+
+Need help? Contact @znashh
+"""
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    # Samples are keyed by (name, sorted label items). Everything is recorded
+    # from the event loop thread, so no locking is needed.
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def _labels(self, labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{name}="{self._escape(value)}"' for name, value in items) + "}"
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), value in sorted(self.gauges.items()):
+            declare(name, "gauge")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+current_span = contextvars.ContextVar("current_span", default=None)
+
+class Span:
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+        self.children = []
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def to_dict(self):
+        result = {"name": self.name, **self.tags}
+        result["ms"] = round(self.duration * 1000, 3) if self.duration is not None else None
+        if self.children:
+            result["children"] = [child.to_dict() for child in self.children]
+        return result
+
+@contextlib.contextmanager
+def span(name, **tags):
+    # Nested under the span of the running task; free outside a traced update
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = Span(name, tags)
+    parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield child
+    finally:
+        child.finish()
+        current_span.reset(token)
+
+@contextlib.contextmanager
+def trace(name, **tags):
+    if TRACE_SLOW_MS <= 0:
+        yield None
+        return
+    root = Span(name, tags)
+    token = current_span.set(root)
+    try:
+        yield root
+    finally:
+        root.finish()
+        current_span.reset(token)
+        if root.duration * 1000 >= TRACE_SLOW_MS:
+            logger.warning(f"Slow update: {json.dumps(root.to_dict(), default=str)}")
+
+class HandlerProfiler:
+    # While a capture window is open a sample of updates runs under one
+    # shared cProfile.Profile, dumped to a file when the window closes.
+    # The profiler stays enabled while a sampled update awaits, so the
+    # capture also holds whatever else ran on the event loop meanwhile
+    # (other updates, jobs, the notifier); read it as loop time around
+    # sampled updates, not as the cost of those updates alone. Only one
+    # sampled update enables the profiler at a time.
+    def __init__(self):
+        self.profile = None
+        self.path = None
+        self.timer = None
+        self.active = False
+        self.sampled = 0
+
+    def start(self, minutes, path):
+        if self.profile is not None:
+            return False
+        self.profile = cProfile.Profile()
+        self.path = path
+        self.sampled = 0
+        self.timer = asyncio.create_task(self._stop_later(minutes * 60))
+        logger.info(f"Profiling {PROFILE_SAMPLE_RATE:.0%} of updates for {minutes:g} min into {path}")
+        return True
+
+    async def _stop_later(self, delay):
+        await asyncio.sleep(delay)
+        self.timer = None
+        self.stop()
+
+    def stop(self):
+        if self.profile is None:
+            return None
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        profile, path, self.profile, self.path = self.profile, self.path, None, None
+        try:
+            profile.dump_stats(path)
+        except OSError as e:
+            # Keep the capture rather than lose it to a bad PROFILE_DIR
+            fallback = os.path.join(tempfile.gettempdir(), os.path.basename(path))
+            logger.error(f"Failed to write profile to {path}: {str(e)}; writing to {fallback}")
+            path = fallback
+            try:
+                profile.dump_stats(path)
+            except OSError as e:
+                logger.error(f"Failed to write profile to {path}: {str(e)}")
+                return None
+        logger.info(f"Profile of {self.sampled} updates written to {path}")
+        return path
+
+    @contextlib.contextmanager
+    def sample(self):
+        profile = self.profile
+        if profile is None or self.active or random.random() >= PROFILE_SAMPLE_RATE:
+            yield
+            return
+        self.active = True
+        self.sampled += 1
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.active = False
+
+profiler = HandlerProfiler()
+
+class UserLocks:
+    # One lock per user id, created on demand and dropped once nobody holds or
+    # waits for it. Locks for several users are always taken in sorted order,
+    # so two updates touching the same pair cannot deadlock.
+    def __init__(self):
+        self.locks = {}
+
+    def _unref(self, user_id):
+        entry = self.locks[user_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.locks[user_id]
+
+    @contextlib.asynccontextmanager
+    async def hold(self, user_ids):
+        held = []
+        try:
+            for user_id in sorted(set(user_ids)):
+                entry = self.locks.get(user_id)
+                if entry is None:
+                    entry = self.locks[user_id] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                try:
+                    await entry[0].acquire()
+                except BaseException:
+                    self._unref(user_id)
+                    raise
+                held.append(user_id)
+            yield
+        finally:
+            for user_id in reversed(held):
+                self.locks[user_id][0].release()
+                self._unref(user_id)
+
+def update_user_ids(update):
+    if not isinstance(update, Update) or update.effective_user is None:
+        return []
+    user_ids = [update.effective_user.id]
+    # Accepting or declining writes the sender's side of the match as well
+    data = update.callback_query.data if update.callback_query else None
+    if data:
+        action, _, other_id = data.partition("_")
+        if action in ("accept", "decline") and other_id.isdigit():
+            user_ids.append(int(other_id))
+    return user_ids
+
+class BotApplication(Application):
+    # Traces and samples every update, and with concurrent updates enabled
+    # runs updates of different users in parallel while those touching the
+    # same user are serialized. PTB's own concurrency limit is effectively
+    # unbounded, since an update holds its slot while it waits for the user
+    # lock; dispatch_slots, taken after the lock, is the only limit.
+    # Session state is written through before the lock is released, because
+    # the next update of that user reloads it, possibly on another worker.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_locks = UserLocks()
+        self.dispatch_slots = asyncio.Semaphore(1)
+
+    async def process_update(self, update):
+        user = update.effective_user if isinstance(update, Update) else None
+        with trace("update", update_id=getattr(update, "update_id", None), user=user.id if user else None):
+            if not self.concurrent_updates:
+                with profiler.sample():
+                    await super().process_update(update)
+                await self.write_through()
+                return
+            async with self.user_locks.hold(update_user_ids(update)):
+                async with self.dispatch_slots:
+                    with profiler.sample():
+                        await super().process_update(update)
+                await self.write_through()
+
+    async def write_through(self):
+        if self.persistence:
+            with span("persistence"):
+                await self.update_persistence()
+                await self.persistence.flush()
+
+def instrumented(handler):
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with span(name):
+                return await handler(*args, **kwargs)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            metrics.observe("bot_handler_duration_seconds", time.perf_counter() - started, handler=name)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    async def do_request(self, url, method, *args, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            with span("telegram", method=endpoint):
+                code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.inc("telegram_api_errors_total", method=endpoint)
+            raise
+        finally:
+            metrics.observe("telegram_api_duration_seconds", time.perf_counter() - started, method=endpoint)
+        if code >= 400:
+            metrics.inc("telegram_api_errors_total", method=endpoint)
+        return code, payload
+
+class HttpServer:
+    # Minimal HTTP/1.1 server on the bot's own event loop. Routes map
+    # (method, path) to coroutines taking (headers, body) and returning
+    # (status, content_type, payload).
+    def __init__(self, port):
+        self.port = port
+        self.routes = {}
+        self.server = None
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "0.0.0.0", self.port)
+        logger.info(f"HTTP server running on port {self.port}")
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def _read_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1")
+        method, target, _ = request_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length", 0))
+        if length > HTTP_MAX_BODY:
+            raise ValueError(f"Request body too large: {length}")
+        body = await reader.readexactly(length) if length else b""
+        return method, target.split("?", 1)[0], headers, body
+
+    async def _handle(self, reader, writer):
+        try:
+            method, path, headers, body = await asyncio.wait_for(self._read_request(reader), HTTP_READ_TIMEOUT)
+            handler = self.routes.get((method, path))
+        except Exception as e:
+            logger.warning(f"Bad HTTP request: {str(e)}")
+            handler, status, content_type, payload = None, 400, "text/plain", b"Bad Request"
+        else:
+            status, content_type, payload = 404, "text/plain", b"Not Found"
+        if handler is not None:
+            try:
+                status, content_type, payload = await handler(headers, body)
+            except Exception as e:
+                logger.error(f"HTTP handler error on {method} {path}: {str(e)}")
+                status, content_type, payload = 500, "text/plain", b"Internal Server Error"
+        try:
+            writer.write(
+                f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1") + payload
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+class ProfileCache:
+    # Entries are deep-copied on the way in and out because handlers mutate
+    # the profile dicts they get back before saving them.
+    def __init__(self, maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.enabled = True
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, user_id):
+        if not self.enabled:
+            self.misses += 1
+            return None
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[user_id]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return copy.deepcopy(entry[1])
+
+    def put(self, user_id, data, version=None):
+        # A read that started before an invalidation may carry the old row
+        if self.maxsize <= 0 or not self.enabled or (version is not None and version != self.version):
+            return
+        self.entries[user_id] = (time.monotonic() + self.ttl, copy.deepcopy(data))
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, user_id):
+        self.version += 1
+        self.entries.pop(user_id, None)
+
+    def clear(self):
+        self.version += 1
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+class ConnectionPool(ThreadedConnectionPool):
+    # psycopg2 closes every returned connection beyond minconn, so with
+    # minconn < maxconn most queries would reconnect. Connections are opened
+    # on demand and all of them, up to maxconn, are kept once opened.
+    # Callers take one of the pool's slots per checked out connection, so
+    # getconn() never runs dry even when several pools share one executor.
+    def __init__(self, maxconn, *args, **kwargs):
+        super().__init__(0, maxconn, *args, **kwargs)
+        self.minconn = maxconn
+        self.slots = asyncio.Semaphore(maxconn)
+
+class Replica:
+    def __init__(self, dsn, pool_size):
+        # No connections are opened up front, so a replica that is down at
+        # startup only shows up as unhealthy
+        self.pool = ConnectionPool(pool_size, dsn)
+        self.healthy = False
+        self.lag = None
+
+    def status(self):
+        return {"healthy": self.healthy, "lag_seconds": self.lag}
+
+class Database:
+    def __init__(self):
+        self.pool_size = int(os.getenv("DB_POOL_SIZE", 10))
+        self.pool = ConnectionPool(self.pool_size, os.getenv("DATABASE_URL"))
+        self.replicas = [Replica(dsn, self.pool_size) for dsn in READ_REPLICA_URLS]
+        self.replica_turn = 0
+        self.recent_writes = {}
+        self.monitor_task = None
+        self.listen_task = None
+        # One thread per connection across all pools; each pool's slots keep
+        # a busy pool from taking more threads than it has connections
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.pool_size * (1 + len(self.replicas)),
+            thread_name_prefix="db"
+        )
+        self.instrument_columns_ready = False
+        self.cache = ProfileCache()
+        self._execute(self._create_tables)
+        self._execute(self._migrate_edges)
+        self._execute(self._create_indexes)
+
+    def _execute(self, operation, *args, pool=None):
+        pool = pool or self.pool
+        for attempt in range(DB_RECONNECT_ATTEMPTS + 1):
+            conn = None
+            try:
+                conn = pool.getconn()
+                result = operation(conn, *args)
+                conn.commit()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                if conn is not None:
+                    pool.putconn(conn, close=True)
+                if attempt == DB_RECONNECT_ATTEMPTS:
+                    raise
+                logger.warning(f"Database connection lost, reconnecting: {str(e)}")
+                continue
+            except Exception:
+                if conn is not None:
+                    conn.rollback()
+                    pool.putconn(conn)
+                raise
+            pool.putconn(conn)
+            return result
+
+    async def _run(self, operation, *args, pool=None):
+        method = operation.__name__.lstrip("_")
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            with span("db", method=method, replica=pool is not None):
+                async with (pool or self.pool).slots:
+                    return await loop.run_in_executor(
+                        self.executor, functools.partial(self._execute, operation, *args, pool=pool)
+                    )
+        except Exception:
+            metrics.inc("db_errors_total", method=method)
+            raise
+        finally:
+            metrics.observe("db_query_duration_seconds", time.perf_counter() - started, method=method)
+
+    def _replica(self, user_id=None):
+        # Users who wrote within the window read from the primary so they see
+        # their own change even if the replicas have not replayed it yet
+        if user_id is not None and time.monotonic() - self.recent_writes.get(user_id, float("-inf")) < READ_YOUR_WRITES_WINDOW:
+            return None
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return None
+        self.replica_turn += 1
+        return healthy[self.replica_turn % len(healthy)]
+
+    def _wrote(self, *user_ids):
+        if self.replicas:
+            now = time.monotonic()
+            for user_id in user_ids:
+                self.recent_writes[user_id] = now
+
+    async def _read(self, user_id, operation, *args):
+        replica = self._replica(user_id)
+        if replica is not None:
+            try:
+                return await self._run(operation, *args, pool=replica.pool)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                replica.healthy = False
+                logger.warning(f"Read replica failed, falling back to primary: {str(e)}")
+        return await self._run(operation, *args)
+
+    def _replica_lag(self, conn):
+        with conn.cursor() as cur:
+            # A standby that has replayed everything it received is current,
+            # however long ago the last transaction was
+            cur.execute("""
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+                END
+            """)
+            lag = cur.fetchone()[0]
+            return float(lag) if lag is not None else None
+
+    async def check_replicas(self):
+        for replica in self.replicas:
+            try:
+                replica.lag = await asyncio.wait_for(self._run(self._replica_lag, pool=replica.pool), HEALTH_DB_TIMEOUT)
+            except Exception as e:
+                replica.lag = None
+                if replica.healthy:
+                    logger.warning(f"Read replica unavailable: {str(e)}")
+            healthy = replica.lag is not None and replica.lag <= REPLICA_MAX_LAG
+            if replica.healthy and not healthy and replica.lag is not None:
+                logger.warning(f"Read replica lagging {replica.lag:.1f}s, routing reads to primary")
+            replica.healthy = healthy
+        cutoff = time.monotonic() - READ_YOUR_WRITES_WINDOW
+        self.recent_writes = {user_id: at for user_id, at in self.recent_writes.items() if at > cutoff}
+
+    async def _monitor_replicas(self):
+        while True:
+            await self.check_replicas()
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+    async def start_replica_monitor(self):
+        if self.replicas:
+            await self.check_replicas()
+            self.monitor_task = asyncio.create_task(self._monitor_replicas())
+
+    async def stop_replica_monitor(self):
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            await asyncio.gather(self.monitor_task, return_exceptions=True)
+            self.monitor_task = None
+
+    def _listen_connection(self):
+        conn = psycopg2.connect(os.getenv("DATABASE_URL"))
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("LISTEN profile_changed")
+        return conn
+
+    async def _listen_profile_changes(self):
+        # The cache is only trusted while this process is listening: it is
+        # switched off and emptied whenever the LISTEN connection is down,
+        # since changes made by other workers in the meantime are missed
+        loop = asyncio.get_running_loop()
+        while True:
+            conn = None
+            try:
+                conn = await loop.run_in_executor(self.executor, self._listen_connection)
+                lost = asyncio.Event()
+
+                def receive():
+                    try:
+                        conn.poll()
+                    except psycopg2.Error:
+                        lost.set()
+                        return
+                    while conn.notifies:
+                        user_id = conn.notifies.pop(0).payload
+                        self.cache.invalidate(user_id)
+                        # Replicas may not have replayed that write yet
+                        self._wrote(user_id)
+
+                loop.add_reader(conn.fileno(), receive)
+                self.cache.clear()
+                self.cache.enabled = True
+                try:
+                    await lost.wait()
+                finally:
+                    loop.remove_reader(conn.fileno())
+                logger.warning("Profile change listener lost its connection, reconnecting")
+            except psycopg2.Error as e:
+                logger.warning(f"Profile change listener unavailable: {str(e)}")
+            finally:
+                self.cache.enabled = False
+                self.cache.clear()
+                if conn is not None:
+                    conn.close()
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+
+    async def start_cache_invalidation(self):
+        self.cache.enabled = False
+        self.listen_task = asyncio.create_task(self._listen_profile_changes())
+
+    async def stop_cache_invalidation(self):
+        if self.listen_task:
+            self.listen_task.cancel()
+            await asyncio.gather(self.listen_task, return_exceptions=True)
+            self.listen_task = None
+
+    def replica_status(self):
+        return [replica.status() for replica in self.replicas]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.closeall()
+        for replica in self.replicas:
+            replica.pool.closeall()
+
+    def pool_status(self):
+        return {
+            "size": self.pool.maxconn,
+            "in_use": len(self.pool._used),
+            "idle": len(self.pool._pool),
+            "closed": self.pool.closed
+        }
+
+    def _ping(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+
+    async def ping(self):
+        try:
+            await asyncio.wait_for(self._run(self._ping), HEALTH_DB_TIMEOUT)
+            return True
+        except Exception as e:
+            logger.error(f"Database error in ping: {str(e)}")
+            return False
+
+    @staticmethod
+    def _decode(value):
+        return json.loads(value) if isinstance(value, str) else value
+
+    def _create_tables(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id TEXT PRIMARY KEY,
+                    data JSONB NOT NULL
+                )
+            """)
+            # instruments/seeking mirrored out of the JSONB document into
+            # indexable columns; the trigger keeps them in step with every write
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS instruments TEXT[]")
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS seeking TEXT[]")
+            # Full-text document for search: name and instruments weigh more than the bio
+            cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS search TSVECTOR")
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION users_sync_instruments() RETURNS trigger AS $$
+                BEGIN
+                    NEW.instruments := ARRAY(SELECT jsonb_array_elements_text(COALESCE(NEW.data->'instruments', '[]'::jsonb)));
+                    NEW.seeking := ARRAY(SELECT jsonb_array_elements_text(COALESCE(NEW.data->'seeking', '[]'::jsonb)));
+                    NEW.search := setweight(to_tsvector(%(config)s::regconfig, COALESCE(NEW.data->>'name', '')), 'A')
+                        || setweight(to_tsvector(%(config)s::regconfig, array_to_string(NEW.instruments, ' ')), 'A')
+                        || setweight(to_tsvector(%(config)s::regconfig, COALESCE(NEW.data->>'bio', '')), 'B');
+                    RETURN NEW;
+                END;
+                $$ LANGUAGE plpgsql
+            """, {"config": SEARCH_CONFIG})
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS notifications (
+                    id BIGSERIAL PRIMARY KEY,
+                    chat_id TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    reply_markup JSONB,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            # A worker leases the rows it has queued; rows whose lease ran out
+            # belong to a worker that stopped and are taken over by another
+            cur.execute("ALTER TABLE notifications ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data JSONB NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            # Materialized top-K Smart Match lists. A list is built on first read
+            # and afterwards only the pairs touching a changed profile are redone;
+            # stale marks lists that lost an entry after being cut at the limit.
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS smart_matches (
+                    user_id TEXT NOT NULL,
+                    candidate_id TEXT NOT NULL,
+                    score INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, candidate_id)
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS smart_matches_rank ON smart_matches (user_id, score DESC, candidate_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS smart_matches_candidate ON smart_matches (candidate_id)")
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS smart_match_state (
+                    user_id TEXT PRIMARY KEY,
+                    stale BOOLEAN NOT NULL DEFAULT false
+                )
+            """)
+            # Social graph: (src, kind, dst) means src has requested, matched or
+            # viewed dst. The primary key answers membership checks, the reverse
+            # index serves incoming requests.
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS user_edges (
+                    src TEXT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+                    kind TEXT NOT NULL CHECK (kind IN ('like', 'pending', 'match', 'viewed')),
+                    dst TEXT NOT NULL REFERENCES users (user_id) ON DELETE CASCADE,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    PRIMARY KEY (src, kind, dst)
+                )
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS user_edges_incoming ON user_edges (dst, kind, src)")
+            # Every worker keeps a profile cache; changed or deleted profiles are
+            # announced so the other workers drop their copy
+            cur.execute("""
+                CREATE OR REPLACE FUNCTION users_notify_change() RETURNS trigger AS $$
+                BEGIN
+                    IF TG_OP = 'DELETE' THEN
+                        PERFORM pg_notify('profile_changed', OLD.user_id);
+                    ELSE
+                        PERFORM pg_notify('profile_changed', NEW.user_id);
+                    END IF;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS users_notify_update ON users")
+            cur.execute("""
+                CREATE TRIGGER users_notify_update
+                AFTER UPDATE OF data ON users
+                FOR EACH ROW WHEN (OLD.data IS DISTINCT FROM NEW.data)
+                EXECUTE FUNCTION users_notify_change()
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS users_notify_delete ON users")
+            cur.execute("""
+                CREATE TRIGGER users_notify_delete
+                AFTER DELETE ON users
+                FOR EACH ROW EXECUTE FUNCTION users_notify_change()
+            """)
+            cur.execute("DROP TRIGGER IF EXISTS users_sync_instruments ON users")
+            cur.execute("""
+                CREATE TRIGGER users_sync_instruments
+                BEFORE INSERT OR UPDATE OF data ON users
+                FOR EACH ROW EXECUTE FUNCTION users_sync_instruments()
+            """)
+
+    def _migrate_edges(self, conn):
+        # Moves the likes/pending/matches/viewed arrays out of the documents.
+        # Both statements are no-ops once no document carries the arrays.
+        # Entries pointing at users that no longer exist cannot be kept and
+        # are logged before the arrays are dropped.
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH edges AS (
+                    SELECT u.user_id AS src, k.kind, e.dst,
+                        EXISTS (SELECT 1 FROM users d WHERE d.user_id = e.dst) AS known
+                    FROM users u
+                    CROSS JOIN (VALUES ('likes', 'like'), ('pending', 'pending'), ('matches', 'match'), ('viewed', 'viewed')) AS k (field, kind)
+                    CROSS JOIN LATERAL jsonb_array_elements_text(COALESCE(u.data->k.field, '[]'::jsonb)) AS e (dst)
+                    WHERE u.data ?| ARRAY['likes', 'pending', 'matches', 'viewed']
+                ), inserted AS (
+                    INSERT INTO user_edges (src, kind, dst)
+                    SELECT src, kind, dst FROM edges WHERE known
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT src, kind, dst FROM edges WHERE NOT known ORDER BY src, kind, dst
+            """)
+            dropped = cur.fetchall()
+            if dropped:
+                logger.warning(
+                    f"Dropped {len(dropped)} relationship entries to missing users: "
+                    + ", ".join(f"{src} {kind} {dst}" for src, kind, dst in dropped)
+                )
+            cur.execute("""
+                UPDATE users SET data = data - ARRAY['likes', 'pending', 'matches', 'viewed']
+                WHERE data ?| ARRAY['likes', 'pending', 'matches', 'viewed']
+            """)
+            if cur.rowcount:
+                logger.info(f"Migrated relationship lists of {cur.rowcount} users to user_edges")
+
+    def _create_indexes(self, conn):
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS users_instruments_gin ON users USING GIN (instruments)")
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS users_seeking_gin ON users USING GIN (seeking)")
+                cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS users_search_gin ON users USING GIN (search)")
+        finally:
+            conn.autocommit = False
+
+    def _backfill_batch(self, conn, batch_size):
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users SET data = data
+                WHERE user_id IN (
+                    SELECT user_id FROM users
+                    WHERE instruments IS NULL OR seeking IS NULL OR search IS NULL
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """, (batch_size,))
+            return cur.rowcount
+
+    def _get_user(self, conn, user_id):
+        with conn.cursor() as cur:
+            cur.execute("SELECT data FROM users WHERE user_id = %s", (user_id,))
+            result = cur.fetchone()
+            return self._decode(result[0]) if result else None
+
+    def _register_user(self, conn, user_id, data):
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (user_id, data)
+                VALUES (%(user_id)s, %(data)s)
+                ON CONFLICT (user_id) DO UPDATE
+                SET data = users.data || jsonb_build_object('name', %(name)s::text, 'username', %(username)s::text)
+                RETURNING data
+            """, {
+                "user_id": user_id,
+                "data": json.dumps(data, default=str),
+                "name": data["name"],
+                "username": data["username"]
+            })
+            return self._decode(cur.fetchone()[0])
+
+    def _set_items(self, conn, user_id, items, session_version=None):
+        with conn.cursor() as cur:
+            if session_version is not None:
+                # Consume the buffer stored with the session, but only the
+                # version the caller holds; otherwise leave the row alone
+                cur.execute("""
+                    UPDATE bot_state
+                    SET data = data - 'profile_edit' - 'profile_edit_version', updated_at = now()
+                    WHERE namespace = 'user_data' AND key = %s AND data ? 'profile_edit'
+                    AND COALESCE(data->'profile_edit_version', '0') = %s::jsonb
+                    RETURNING 1
+                """, (str(user_id), json.dumps(session_version)))
+                if cur.fetchone() is None:
+                    return None
+            cur.execute("""
+                UPDATE users SET data = data || %s::jsonb
+                WHERE user_id = %s
+                RETURNING data
+            """, (json.dumps(items), user_id))
+            result = cur.fetchone()
+        if not result:
+            return None
+        # Smart Match lists change in the same transaction, so a failed
+        # refresh leaves the buffer unapplied rather than the lists wrong
+        data = self._decode(result[0])
+        self._refresh_smart_matches(conn, data)
+        return data
+
+    def _set_bio(self, conn, user_id, bio):
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE users SET data = jsonb_set(data, '{bio}', to_jsonb(%s::text))
+                WHERE user_id = %s
+                RETURNING data
+            """, (bio, user_id))
+            result = cur.fetchone()
+            return self._decode(result[0]) if result else None
+
+    def _add_edge(self, conn, src, kind, dst):
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO user_edges (src, kind, dst) VALUES (%s, %s, %s)
+                ON CONFLICT DO NOTHING
+            """, (src, kind, dst))
+            return cur.rowcount == 1
+
+    def _remove_edge(self, conn, src, kind, dst):
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM user_edges WHERE src = %s AND kind = %s AND dst = %s", (src, kind, dst))
+            return cur.rowcount == 1
+
+    def _view_profile(self, conn, user_id, profile_id):
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO user_edges (src, kind, dst) VALUES (%(user_id)s, 'viewed', %(profile_id)s)
+                ON CONFLICT DO NOTHING
+            """, {"user_id": user_id, "profile_id": profile_id})
+            cur.execute("""
+                SELECT EXISTS (
+                    SELECT 1 FROM user_edges WHERE src = %(user_id)s AND kind = 'match' AND dst = %(profile_id)s
+                )
+            """, {"user_id": user_id, "profile_id": profile_id})
+            return cur.fetchone()[0]
+
+    def _get_edges(self, conn, user_id, kind, incoming):
+        with conn.cursor() as cur:
+            if incoming:
+                cur.execute("SELECT src FROM user_edges WHERE dst = %s AND kind = %s ORDER BY created_at, src", (user_id, kind))
+            else:
+                cur.execute("SELECT dst FROM user_edges WHERE src = %s AND kind = %s ORDER BY created_at, dst", (user_id, kind))
+            return [row[0] for row in cur.fetchall()]
+
+    def _accept_match(self, conn, user_id, sender_id):
+        with conn.cursor() as cur:
+            # Only a request the sender actually made can be accepted
+            cur.execute("""
+                DELETE FROM user_edges WHERE src = %s AND kind = 'pending' AND dst = %s
+                RETURNING src
+            """, (sender_id, user_id))
+            if cur.fetchone() is None:
+                return None
+            cur.execute("SELECT user_id, data FROM users WHERE user_id IN (%s, %s)", (user_id, sender_id))
+            users = {row[0]: self._decode(row[1]) for row in cur.fetchall()}
+            if len(users) < 2:
+                return None
+            cur.execute("""
+                DELETE FROM user_edges WHERE src = %s AND kind = 'pending' AND dst = %s
+            """, (user_id, sender_id))
+            cur.execute("""
+                INSERT INTO user_edges (src, kind, dst)
+                VALUES (%(user_id)s, 'match', %(sender_id)s), (%(sender_id)s, 'match', %(user_id)s)
+                ON CONFLICT DO NOTHING
+            """, {"user_id": user_id, "sender_id": sender_id})
+            return users[user_id], users[sender_id]
+
+    def _get_users(self, conn, user_ids):
+        with conn.cursor() as cur:
+            cur.execute("SELECT user_id, data FROM users WHERE user_id = ANY(%s)", (list(user_ids),))
+            found = {row[0]: self._decode(row[1]) for row in cur.fetchall()}
+            return [found[user_id] for user_id in user_ids if user_id in found]
+
+    def _candidate_filter(self, user, mode):
+        params = {
+            "user_id": user["user_id"],
+            "instruments": user["instruments"],
+            "seeking": user["seeking"]
+        }
+        if mode != "smart":
+            return """
+                user_id <> %(user_id)s
+                AND NOT EXISTS (
+                    SELECT 1 FROM user_edges
+                    WHERE src = %(user_id)s AND kind = 'pending' AND dst = users.user_id
+                )
+            """, params
+        if self.instrument_columns_ready:
+            return """
+                user_id <> %(user_id)s
+                AND instruments && %(seeking)s::text[]
+                AND seeking && %(instruments)s::text[]
+            """, params
+        # Rows not yet backfilled still carry their arrays only in JSONB
+        return """
+            user_id <> %(user_id)s
+            AND COALESCE(instruments && %(seeking)s::text[], data->'instruments' ?| %(seeking)s::text[])
+            AND COALESCE(seeking && %(instruments)s::text[], data->'seeking' ?| %(instruments)s::text[])
+        """, params
+
+    # Overlap counted from the JSONB arrays so it is right even before backfill
+    SMART_MATCH_SCORE = """
+        (SELECT count(*) FROM jsonb_array_elements_text(data->'instruments') AS i WHERE i = ANY(%(seeking)s::text[]))
+        + (SELECT count(*) FROM jsonb_array_elements_text(data->'seeking') AS s WHERE s = ANY(%(instruments)s::text[]))
+    """
+
+    def _rebuild_smart_matches(self, cur, user):
+        where, params = self._candidate_filter(user, "smart")
+        params["limit"] = SMART_MATCH_LIMIT
+        cur.execute("DELETE FROM smart_matches WHERE user_id = %(user_id)s", params)
+        cur.execute(f"""
+            INSERT INTO smart_matches (user_id, candidate_id, score)
+            SELECT %(user_id)s, user_id, {self.SMART_MATCH_SCORE} AS score
+            FROM users WHERE {where}
+            ORDER BY score DESC, user_id LIMIT %(limit)s
+            ON CONFLICT (user_id, candidate_id) DO UPDATE SET score = EXCLUDED.score
+        """, params)
+        cur.execute("""
+            INSERT INTO smart_match_state (user_id, stale) VALUES (%(user_id)s, false)
+            ON CONFLICT (user_id) DO UPDATE SET stale = false
+        """, params)
+
+    def _refresh_smart_matches(self, conn, user):
+        where, params = self._candidate_filter(user, "smart")
+        params["limit"] = SMART_MATCH_LIMIT
+        with conn.cursor() as cur:
+            # Full lists that drop this user may now be missing someone who was
+            # cut off below the limit; they are rebuilt on their next read
+            cur.execute("""
+                UPDATE smart_match_state SET stale = true
+                WHERE user_id IN (
+                    SELECT m.user_id FROM smart_matches m
+                    WHERE m.candidate_id = %(user_id)s
+                    AND (SELECT count(*) FROM smart_matches f WHERE f.user_id = m.user_id) >= %(limit)s
+                )
+            """, params)
+            cur.execute("DELETE FROM smart_matches WHERE candidate_id = %(user_id)s", params)
+            self._rebuild_smart_matches(cur, user)
+            # The mutual-overlap predicate is symmetric, so the same candidates
+            # gain this user in their own lists (only lists already materialized)
+            cur.execute(f"""
+                INSERT INTO smart_matches (user_id, candidate_id, score)
+                SELECT user_id, %(user_id)s, {self.SMART_MATCH_SCORE}
+                FROM users WHERE {where}
+                AND user_id IN (SELECT user_id FROM smart_match_state)
+                ON CONFLICT (user_id, candidate_id) DO UPDATE SET score = EXCLUDED.score
+            """, params)
+            cur.execute("""
+                DELETE FROM smart_matches m USING (
+                    SELECT user_id, candidate_id,
+                        row_number() OVER (PARTITION BY user_id ORDER BY score DESC, candidate_id) AS rank
+                    FROM smart_matches
+                    WHERE user_id IN (SELECT user_id FROM smart_matches WHERE candidate_id = %(user_id)s)
+                ) ranked
+                WHERE m.user_id = ranked.user_id AND m.candidate_id = ranked.candidate_id
+                AND ranked.rank > %(limit)s
+            """, params)
+
+    def _smart_match_ids(self, conn, user):
+        with conn.cursor() as cur:
+            cur.execute("SELECT stale FROM smart_match_state WHERE user_id = %s", (user["user_id"],))
+            state = cur.fetchone()
+            if state is None or state[0]:
+                self._rebuild_smart_matches(cur, user)
+            # Profiles already requested or viewed sink below fresh ones
+            cur.execute("""
+                SELECT m.candidate_id FROM smart_matches m
+                LEFT JOIN user_edges p ON p.src = m.user_id AND p.kind = 'pending' AND p.dst = m.candidate_id
+                LEFT JOIN user_edges v ON v.src = m.user_id AND v.kind = 'viewed' AND v.dst = m.candidate_id
+                WHERE m.user_id = %s
+                ORDER BY p.dst IS NOT NULL, v.dst IS NOT NULL, m.score DESC, m.candidate_id
+            """, (user["user_id"],))
+            return [row[0] for row in cur.fetchall()]
+
+    SEARCH_RANKED = """
+        SELECT user_id, ts_rank_cd(search, q) AS rank
+        FROM users, websearch_to_tsquery(%(config)s::regconfig, %(query)s) AS q
+        WHERE search @@ q AND user_id <> %(user_id)s
+    """
+
+    def _search_candidates(self, conn, user, query, after, before, limit):
+        # Keyset pages over (rank DESC, user_id). Anchors are the (rank,
+        # user_id) keys of the page boundary as they were returned, so a page
+        # still continues after its anchor profile stopped matching.
+        params = {"config": SEARCH_CONFIG, "query": query, "user_id": user["user_id"], "limit": limit}
+        with conn.cursor() as cur:
+            if after is None and before is None:
+                cur.execute(f"{self.SEARCH_RANKED} ORDER BY rank DESC, user_id LIMIT %(limit)s", params)
+                return [[row[1], row[0]] for row in cur.fetchall()]
+            if after is not None:
+                params["rank"], params["anchor"] = after
+                condition = "rank < %(rank)s::real OR (rank = %(rank)s::real AND user_id > %(anchor)s)"
+                order = "rank DESC, user_id"
+            else:
+                params["rank"], params["anchor"] = before
+                condition = "rank > %(rank)s::real OR (rank = %(rank)s::real AND user_id < %(anchor)s)"
+                order = "rank, user_id DESC"
+            cur.execute(f"""
+                SELECT user_id, rank FROM ({self.SEARCH_RANKED}) ranked
+                WHERE {condition}
+                ORDER BY {order} LIMIT %(limit)s
+            """, params)
+            keys = [[row[1], row[0]] for row in cur.fetchall()]
+            return keys if after is not None else keys[::-1]
+
+    def _find_candidate_ids(self, conn, user, mode, after, before, limit):
+        if mode == "smart":
+            # Ranked lists are bounded by SMART_MATCH_LIMIT and returned whole
+            return self._smart_match_ids(conn, user) if after is None and before is None else []
+        where, params = self._candidate_filter(user, mode)
+        params.update({"after": after, "before": before, "limit": limit})
+        with conn.cursor() as cur:
+            if before is not None:
+                cur.execute(f"""
+                    SELECT user_id FROM users WHERE {where} AND user_id < %(before)s
+                    ORDER BY user_id DESC LIMIT %(limit)s
+                """, params)
+                return [row[0] for row in reversed(cur.fetchall())]
+            if after is not None:
+                where += " AND user_id > %(after)s"
+            cur.execute(f"SELECT user_id FROM users WHERE {where} ORDER BY user_id LIMIT %(limit)s", params)
+            return [row[0] for row in cur.fetchall()]
+
+    def _count_candidates(self, conn, user, mode, query=None):
+        with conn.cursor() as cur:
+            if mode == "search":
+                cur.execute(
+                    f"SELECT count(*) FROM ({self.SEARCH_RANKED}) ranked",
+                    {"config": SEARCH_CONFIG, "query": query, "user_id": user["user_id"]}
+                )
+                return cur.fetchone()[0]
+            if mode == "smart":
+                cur.execute("SELECT count(*) FROM smart_matches WHERE user_id = %s", (user["user_id"],))
+                return cur.fetchone()[0]
+            where, params = self._candidate_filter(user, mode)
+            cur.execute(f"SELECT count(*) FROM users WHERE {where}", params)
+            return cur.fetchone()[0]
+
+    def _add_notification(self, conn, chat_id, text, reply_markup):
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO notifications (chat_id, text, reply_markup, claimed_until)
+                VALUES (%s, %s, %s, now() + %s * interval '1 second')
+                RETURNING id
+            """, (chat_id, text, json.dumps(reply_markup) if reply_markup else None, NOTIFY_CLAIM_LEASE))
+            return cur.fetchone()[0]
+
+    def _delete_notification(self, conn, notification_id):
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM notifications WHERE id = %s", (notification_id,))
+
+    def _claim_notifications(self, conn, held_ids, limit):
+        with conn.cursor() as cur:
+            if held_ids:
+                cur.execute("""
+                    UPDATE notifications SET claimed_until = now() + %s * interval '1 second'
+                    WHERE id = ANY(%s)
+                """, (NOTIFY_CLAIM_LEASE, held_ids))
+            if limit <= 0:
+                return []
+            cur.execute("""
+                UPDATE notifications SET claimed_until = now() + %s * interval '1 second'
+                WHERE id IN (
+                    SELECT id FROM notifications
+                    WHERE claimed_until IS NULL OR claimed_until < now()
+                    ORDER BY id LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING id, chat_id, text, reply_markup
+            """, (NOTIFY_CLAIM_LEASE, limit))
+            return sorted((
+                {"id": row[0], "chat_id": row[1], "text": row[2], "reply_markup": self._decode(row[3])}
+                for row in cur.fetchall()
+            ), key=lambda notification: notification["id"])
+
+    def _load_states(self, conn, keys):
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT namespace, key, data FROM bot_state
+                WHERE (namespace, key) IN (SELECT * FROM unnest(%s::text[], %s::text[]))
+            """, ([namespace for namespace, _ in keys], [key for _, key in keys]))
+            return {(row[0], row[1]): self._decode(row[2]) for row in cur.fetchall()}
+
+    def _save_states(self, conn, states):
+        upserts = [
+            (namespace, key, json.dumps(data, default=str))
+            for (namespace, key), data in states.items() if data is not None
+        ]
+        deletes = [(namespace, key) for (namespace, key), data in states.items() if data is None]
+        with conn.cursor() as cur:
+            if upserts:
+                execute_values(cur, """
+                    INSERT INTO bot_state (namespace, key, data) VALUES %s
+                    ON CONFLICT (namespace, key) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                """, upserts)
+            if deletes:
+                execute_values(cur, "DELETE FROM bot_state WHERE (namespace, key) IN (VALUES %s)", deletes)
+
+    def _get_profile_edits(self, conn, min_age):
+        # Buffers touched recently may belong to a session live on another worker
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT key, data FROM bot_state
+                WHERE namespace = 'user_data' AND data ? 'profile_edit'
+                AND updated_at < now() - %s * interval '1 second'
+            """, (min_age,))
+            return {row[0]: self._decode(row[1]) for row in cur.fetchall()}
+
+    def _count_users(self, conn):
+        with conn.cursor() as cur:
+            cur.execute("SELECT count(*) FROM users")
+            return cur.fetchone()[0]
+
+    def _has_other_users(self, conn, user_id):
+        with conn.cursor() as cur:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM users WHERE user_id <> %s)", (user_id,))
+            return cur.fetchone()[0]
+
+    # CSV with quote and delimiter bytes that never occur in JSON text, so
+    # COPY passes each document through as one raw line without escaping
+    NDJSON_COPY_OPTIONS = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+
+    @staticmethod
+    def _rewind(stream, start, copy_state):
+        # A reconnect retry must not append to or resume a half-copied stream.
+        # Only files the admin command opened itself are rewound; anything
+        # else, such as stdout redirected with >>, is left alone.
+        if copy_state["started"]:
+            if start is None:
+                raise RuntimeError("Connection lost during COPY on a stream that cannot be rewound")
+            stream.seek(start)
+            if stream.writable():
+                stream.truncate()
+        copy_state["started"] = True
+
+    def _export_users(self, conn, out, start, copy_state):
+        self._rewind(out, start, copy_state)
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY (SELECT data FROM users ORDER BY user_id) TO STDOUT WITH ({self.NDJSON_COPY_OPTIONS})", out)
+            return cur.rowcount
+
+    def _import_users(self, conn, source, start, copy_state):
+        self._rewind(source, start, copy_state)
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE users_import (data JSONB) ON COMMIT DROP")
+            cur.copy_expert(f"COPY users_import (data) FROM STDIN WITH ({self.NDJSON_COPY_OPTIONS})", source)
+            cur.execute("""
+                INSERT INTO users (user_id, data)
+                SELECT DISTINCT ON (data->>'user_id') data->>'user_id', data
+                FROM users_import WHERE data ? 'user_id'
+                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data
+            """)
+            imported = cur.rowcount
+            cur.execute("UPDATE smart_match_state SET stale = true")
+        # Older exports still carry the relationship arrays
+        self._migrate_edges(conn)
+        return imported
+
+    async def get_user(self, user_id):
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached
+        version = self.cache.version
+        try:
+            data = await self._read(user_id, self._get_user, user_id)
+        except Exception as e:
+            logger.error(f"Database error in get_user: {str(e)}")
+            return None
+        if data is not None:
+            self.cache.put(user_id, data, version)
+        return data
+
+    async def _update(self, name, operation, *args):
+        version = self.cache.version
+        try:
+            data = await self._run(operation, *args)
+        except Exception as e:
+            logger.error(f"Database error in {name}: {str(e)}")
+            return None
+        if data is not None:
+            self.cache.put(data["user_id"], data, version)
+            self._wrote(data["user_id"])
+        return data
+
+    async def register_user(self, user_id, data):
+        return await self._update("register_user", self._register_user, user_id, data)
+
+    async def set_items(self, user_id, items, session_version=None):
+        if not set(items) <= set(PROFILE_CATEGORIES):
+            raise ValueError(f"Unknown profile category: {', '.join(sorted(set(items) - set(PROFILE_CATEGORIES)))}")
+        return await self._update("set_items", self._set_items, user_id, items, session_version)
+
+    async def set_bio(self, user_id, bio):
+        return await self._update("set_bio", self._set_bio, user_id, bio)
+
+    async def add_pending(self, user_id, target_id):
+        try:
+            self._wrote(user_id)
+            return await self._run(self._add_edge, user_id, "pending", target_id)
+        except Exception as e:
+            logger.error(f"Database error in add_pending: {str(e)}")
+            return False
+
+    async def remove_pending(self, user_id, target_id):
+        try:
+            self._wrote(user_id)
+            return await self._run(self._remove_edge, user_id, "pending", target_id)
+        except Exception as e:
+            logger.error(f"Database error in remove_pending: {str(e)}")
+            return False
+
+    async def view_profile(self, user_id, profile_id):
+        try:
+            return await self._run(self._view_profile, user_id, profile_id)
+        except Exception as e:
+            logger.error(f"Database error in view_profile: {str(e)}")
+            return False
+
+    async def get_edges(self, user_id, kind, incoming=False):
+        if kind not in EDGE_KINDS:
+            raise ValueError(f"Unknown edge kind: {kind}")
+        try:
+            return await self._read(user_id, self._get_edges, user_id, kind, incoming)
+        except Exception as e:
+            logger.error(f"Database error in get_edges: {str(e)}")
+            return []
+
+    async def accept_match(self, user_id, sender_id):
+        version = self.cache.version
+        try:
+            self._wrote(user_id, sender_id)
+            result = await self._run(self._accept_match, user_id, sender_id)
+        except Exception as e:
+            logger.error(f"Database error in accept_match: {str(e)}")
+            return None
+        if result is not None:
+            for data in result:
+                self.cache.put(data["user_id"], data, version)
+        return result
+
+    async def get_users(self, user_ids):
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            cached = self.cache.get(user_id)
+            if cached is not None:
+                found[user_id] = cached
+            else:
+                missing.append(user_id)
+        if missing:
+            version = self.cache.version
+            try:
+                fetched = await self._read(None, self._get_users, missing)
+            except Exception as e:
+                logger.error(f"Database error in get_users: {str(e)}")
+                fetched = []
+            for data in fetched:
+                self.cache.put(data["user_id"], data, version)
+                found[data["user_id"]] = data
+        return [found[user_id] for user_id in user_ids if user_id in found]
+
+    async def find_candidate_ids(self, user, mode, after=None, before=None, limit=BROWSE_WINDOW):
+        try:
+            if mode == "smart":
+                # Ranked lists are rebuilt on read, which needs the primary
+                return await self._run(self._find_candidate_ids, user, mode, after, before, limit)
+            return await self._read(user["user_id"], self._find_candidate_ids, user, mode, after, before, limit)
+        except Exception as e:
+            logger.error(f"Database error in find_candidate_ids: {str(e)}")
+            return []
+
+    async def search_candidates(self, user, query, after=None, before=None, limit=BROWSE_WINDOW):
+        try:
+            return await self._read(user["user_id"], self._search_candidates, user, query, after, before, limit)
+        except Exception as e:
+            logger.error(f"Database error in search_candidates: {str(e)}")
+            return []
+
+    async def get_smart_match_ids(self, user):
+        try:
+            return await self._run(self._smart_match_ids, user)
+        except Exception as e:
+            logger.error(f"Database error in get_smart_match_ids: {str(e)}")
+            return []
+
+    async def count_candidates(self, user, mode, query=None):
+        try:
+            if mode == "smart":
+                return await self._run(self._count_candidates, user, mode)
+            return await self._read(user["user_id"], self._count_candidates, user, mode, query)
+        except Exception as e:
+            logger.error(f"Database error in count_candidates: {str(e)}")
+            return 0
+
+    async def backfill_instrument_columns(self):
+        total = 0
+        try:
+            while True:
+                updated = await self._run(self._backfill_batch, BACKFILL_BATCH_SIZE)
+                if not updated:
+                    break
+                total += updated
+        except Exception as e:
+            logger.error(f"Database error in backfill_instrument_columns: {str(e)}")
+            return
+        self.instrument_columns_ready = True
+        logger.info(f"Instrument columns backfilled for {total} profiles")
+
+    async def iter_users(self, batch_size=ITER_BATCH_SIZE):
+        # Streams documents through a server-side cursor on a dedicated
+        # connection, so only one batch is held in memory at a time. The
+        # connection keeps its pool slot until the cursor is released.
+        loop = asyncio.get_running_loop()
+        replica = self._replica()
+        pool = replica.pool if replica else self.pool
+        async with pool.slots:
+            conn = await loop.run_in_executor(self.executor, pool.getconn)
+            cur = conn.cursor(name="iter_users")
+            try:
+                await loop.run_in_executor(self.executor, cur.execute, "SELECT data FROM users ORDER BY user_id")
+                while True:
+                    rows = await loop.run_in_executor(self.executor, cur.fetchmany, batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield self._decode(row[0])
+            finally:
+                await loop.run_in_executor(self.executor, self._release_cursor, pool, conn, cur)
+
+    def _release_cursor(self, pool, conn, cur):
+        try:
+            cur.close()
+            conn.rollback()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            pool.putconn(conn, close=True)
+            return
+        pool.putconn(conn)
+
+    async def count_users(self):
+        try:
+            return await self._read(None, self._count_users)
+        except Exception as e:
+            logger.error(f"Database error in count_users: {str(e)}")
+            return 0
+
+    async def has_other_users(self, user_id):
+        try:
+            return await self._read(None, self._has_other_users, user_id)
+        except Exception as e:
+            logger.error(f"Database error in has_other_users: {str(e)}")
+            return False
+
+    async def export_users(self, out, rewindable=False):
+        return await self._run(self._export_users, out, out.tell() if rewindable else None, {"started": False})
+
+    async def import_users(self, source, rewindable=False):
+        return await self._run(self._import_users, source, source.tell() if rewindable else None, {"started": False})
+
+    async def add_notification(self, chat_id, text, reply_markup=None):
+        try:
+            return await self._run(self._add_notification, chat_id, text, reply_markup)
+        except Exception as e:
+            logger.error(f"Database error in add_notification: {str(e)}")
+            return None
+
+    async def delete_notification(self, notification_id):
+        try:
+            await self._run(self._delete_notification, notification_id)
+        except Exception as e:
+            logger.error(f"Database error in delete_notification: {str(e)}")
+
+    async def claim_notifications(self, held_ids=(), limit=100):
+        try:
+            return await self._run(self._claim_notifications, list(held_ids), limit)
+        except Exception as e:
+            logger.error(f"Database error in claim_notifications: {str(e)}")
+            return []
+
+    async def load_states(self, keys):
+        try:
+            return await self._run(self._load_states, keys)
+        except Exception as e:
+            logger.error(f"Database error in load_states: {str(e)}")
+            return {}
+
+    async def save_states(self, states):
+        try:
+            await self._run(self._save_states, states)
+            return True
+        except Exception as e:
+            logger.error(f"Database error in save_states: {str(e)}")
+            return False
+
+    async def get_profile_edits(self, min_age=PROFILE_EDIT_RECOVER_AGE):
+        try:
+            return await self._run(self._get_profile_edits, min_age)
+        except Exception as e:
+            logger.error(f"Database error in get_profile_edits: {str(e)}")
+            return {}
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self):
+        return self.wait_time() == 0 and self.tokens >= self.capacity
+
+class NotificationDispatcher:
+    # Outbound messages are written to the notifications table before they are
+    # queued and deleted once Telegram accepts them, so anything still in the
+    # table after a crash is picked up again by a sweeper. Each worker holds a
+    # lease on the rows it has queued, so no two workers send the same row.
+    def __init__(self, db):
+        self.db = db
+        self.bot = None
+        self.queue = asyncio.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+        self.queued_ids = set()
+        self.global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.tasks = []
+        self.latencies = deque(maxlen=1000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def start(self, bot):
+        self.bot = bot
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(NOTIFY_WORKERS)]
+        self.tasks.append(asyncio.create_task(self._sweeper()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def enqueue(self, chat_id, text, reply_markup=None):
+        markup = reply_markup.to_dict() if reply_markup else None
+        notification_id = await self.db.add_notification(chat_id, text, markup)
+        self._offer({
+            "id": notification_id,
+            "chat_id": chat_id,
+            "text": text,
+            "reply_markup": markup
+        })
+
+    def _offer(self, notification):
+        if notification["id"] is not None and notification["id"] in self.queued_ids:
+            return
+        notification["enqueued_at"] = time.monotonic()
+        try:
+            self.queue.put_nowait(notification)
+        except asyncio.QueueFull:
+            logger.warning(f"Notification queue full, deferring message to {notification['chat_id']}")
+            return
+        if notification["id"] is not None:
+            self.queued_ids.add(notification["id"])
+
+    async def _sweeper(self):
+        while True:
+            # Renews the lease on everything still queued here and claims
+            # unleased rows for the free queue slots
+            free = self.queue.maxsize - self.queue.qsize()
+            for notification in await self.db.claim_notifications(self.queued_ids, free):
+                self._offer(notification)
+            self.chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self.chat_buckets.items() if not bucket.is_full()
+            }
+            await asyncio.sleep(NOTIFY_SWEEP_INTERVAL)
+
+    async def _worker(self):
+        while True:
+            notification = await self.queue.get()
+            try:
+                await self._deliver(notification)
+            except Exception as e:
+                logger.error(f"Notification delivery error: {str(e)}")
+            finally:
+                self.queued_ids.discard(notification["id"])
+                self.queue.task_done()
+
+    async def _throttle(self, chat_id):
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(NOTIFY_CHAT_RATE, 1))
+        while True:
+            wait = max(self.global_bucket.wait_time(), bucket.wait_time())
+            if wait <= 0:
+                self.global_bucket.take()
+                bucket.take()
+                return
+            await asyncio.sleep(wait)
+
+    async def _deliver(self, notification):
+        reply_markup = None
+        if notification["reply_markup"]:
+            reply_markup = InlineKeyboardMarkup.de_json(notification["reply_markup"], self.bot)
+        for attempt in range(NOTIFY_MAX_ATTEMPTS):
+            await self._throttle(notification["chat_id"])
+            try:
+                await self.bot.send_message(
+                    chat_id=notification["chat_id"],
+                    text=notification["text"],
+                    reply_markup=reply_markup
+                )
+            except RetryAfter as e:
+                delay = e.retry_after
+            except (BadRequest, Forbidden) as e:
+                # The chat is gone or the bot was blocked; retrying cannot help
+                logger.warning(f"Dropping notification to {notification['chat_id']}: {str(e)}")
+                self.failed += 1
+                break
+            except NetworkError:
+                delay = NOTIFY_BACKOFF * 2 ** attempt
+            except TelegramError as e:
+                logger.warning(f"Dropping notification to {notification['chat_id']}: {str(e)}")
+                self.failed += 1
+                break
+            else:
+                self.sent += 1
+                self.latencies.append(time.monotonic() - notification["enqueued_at"])
+                break
+            self.retried += 1
+            await asyncio.sleep(delay)
+        else:
+            # Left in the table; the sweeper will try again later
+            self.failed += 1
+            return
+        if notification["id"] is not None:
+            await self.db.delete_notification(notification["id"])
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            "depth": self.queue.qsize(),
+            "in_flight": len(self.queued_ids),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+            "latency_p95_ms": round(percentile(latencies, 0.95) * 1000, 1)
+        }
+
+class ProfileEditBuffer:
+    # Picker toggles are applied to a copy kept in user_data["profile_edit"],
+    # which is persisted with the session, and written to the users table in
+    # one absolute update on Back or after PROFILE_EDIT_FLUSH_DELAY. Replaying
+    # a buffer is idempotent, so edits left behind by a crash are applied on
+    # the next start once they are older than PROFILE_EDIT_RECOVER_AGE.
+    # Flushes that run outside an update (the timer, shutdown and recovery)
+    # only apply the buffer if the stored session still carries the same
+    # profile_edit_version, and clear it in the same transaction, so a timer
+    # left on one worker cannot undo edits made since on another. Re-renders
+    # are throttled to one per interval per user.
+    def __init__(self, db):
+        self.db = db
+        self.flush_tasks = {}
+        self.render_tasks = {}
+        self.renders = {}
+        self.rendered = {}
+        self.last_render = {}
+
+    def selection(self, user_data, category):
+        return user_data.get("profile_edit", {}).get(category)
+
+    def toggle(self, user_id, context, current_user, category, item):
+        edits = context.user_data.setdefault("profile_edit", {})
+        if category not in edits:
+            edits[category] = list(current_user[category])
+        selection = edits[category]
+        if item in selection:
+            selection.remove(item)
+        else:
+            selection.append(item)
+        context.user_data["profile_edit_version"] = context.user_data.get("profile_edit_version", 0) + 1
+        self._schedule_flush(user_id, context)
+        return selection
+
+    def _schedule_flush(self, user_id, context):
+        pending = self.flush_tasks.pop(user_id, None)
+        if pending:
+            pending[0].cancel()
+        self.flush_tasks[user_id] = (asyncio.create_task(self._flush_later(user_id, context)), context)
+
+    async def _flush_later(self, user_id, context):
+        await asyncio.sleep(PROFILE_EDIT_FLUSH_DELAY)
+        self.flush_tasks.pop(user_id, None)
+        await self._flush_detached(user_id, context)
+
+    async def _flush_detached(self, user_id, context):
+        if context.application.persistence is None:
+            await self._flush(user_id, context.user_data)
+            return
+        # This copy of user_data may be older than the stored session, which
+        # another worker can have flushed or edited further since
+        version = context.user_data.get("profile_edit_version", 0)
+        await self._flush(user_id, context.user_data, session_version=version)
+
+    async def flush(self, user_id, user_data):
+        pending = self.flush_tasks.pop(user_id, None)
+        if pending:
+            pending[0].cancel()
+        self.rendered.pop(user_id, None)
+        self.last_render.pop(user_id, None)
+        return await self._flush(user_id, user_data)
+
+    async def _flush(self, user_id, user_data, session_version=None):
+        if not user_data.get("profile_edit"):
+            return None
+        edits = copy.deepcopy(user_data["profile_edit"])
+        data = await self.db.set_items(user_id, edits, session_version)
+        if data is None:
+            # The buffer stays in user_data and is retried on the next flush;
+            # a stale copy is replaced when the session is next reloaded
+            return None
+        if user_data.get("profile_edit") == edits:
+            user_data.pop("profile_edit")
+            user_data.pop("profile_edit_version", None)
+        metrics.inc("profile_edit_flushes_total")
+        return data
+
+    async def recover(self):
+        for user_id, user_data in (await self.db.get_profile_edits()).items():
+            if await self._flush(user_id, user_data, session_version=user_data.get("profile_edit_version", 0)):
+                logger.info(f"Applied unsaved profile edits for {user_id}")
+
+    async def render(self, user_id, query, text, reply_markup):
+        self.last_render[user_id] = time.monotonic()
+        rendered = (query.message.message_id, text, json.dumps(reply_markup.to_dict()))
+        if self.rendered.get(user_id) == rendered:
+            metrics.inc("profile_edit_renders_skipped_total")
+            return
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup)
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                raise
+        self.rendered[user_id] = rendered
+
+    def render_later(self, user_id, query, text, reply_markup):
+        self.renders[user_id] = (query, text, reply_markup)
+        task = self.render_tasks.get(user_id)
+        if task is None or task.done():
+            self.render_tasks[user_id] = asyncio.create_task(self._render_later(user_id))
+
+    async def _render_later(self, user_id):
+        # The first tap after a quiet period renders at once; taps inside the
+        # interval are folded into a single render of the latest state
+        wait = self.last_render.get(user_id, 0) + PROFILE_EDIT_RENDER_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        query, text, reply_markup = self.renders.pop(user_id)
+        try:
+            await self.render(user_id, query, text, reply_markup)
+        except TelegramError as e:
+            logger.error(f"Failed to render profile picker for {user_id}: {str(e)}")
+
+    async def stop(self):
+        tasks = list(self.render_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for user_id, (task, context) in list(self.flush_tasks.items()):
+            task.cancel()
+            await self._flush_detached(user_id, context)
+        self.flush_tasks = {}
+        self.render_tasks = {}
+
+class PostgresPersistence(BasePersistence):
+    # user_data and conversation states are kept in the bot_state table so any
+    # worker process can continue a session. State is read per update rather
+    # than once at startup, and writes are buffered per (namespace, key) and
+    # flushed together, so repeated writes to one key cost a single upsert.
+    def __init__(self, db):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=PERSISTENCE_INTERVAL
+        )
+        self.db = db
+        self.pending = {}
+        self.flushing = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+
+    @staticmethod
+    def _conversation_namespace(name):
+        return f"conversation:{name}"
+
+    def _write(self, namespace, key, data):
+        self.pending[(namespace, key)] = data
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(PERSISTENCE_FLUSH_DELAY)
+        # From here on the timer is a flush like any other and is not cancelled
+        self.flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        # Batches are written one at a time, so a flush that returns has also
+        # waited for the batch another caller was writing when it started
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, {}
+            self.flushing = batch
+            saved = False
+            try:
+                saved = await self.db.save_states(batch)
+            finally:
+                self.flushing = {}
+                if not saved:
+                    # Keep failed writes for the next flush unless a newer value arrived
+                    for state_key, data in batch.items():
+                        self.pending.setdefault(state_key, data)
+
+    async def refresh_session(self, handler, update, user_data):
+        # Reloads both the conversation state and user_data of the sender in one
+        # query. Keys with local writes that are unflushed or still being
+        # written are already the newest copy.
+        if not (update.effective_chat and update.effective_user):
+            return
+        key = (update.effective_chat.id, update.effective_user.id)
+        conversation_key = (self._conversation_namespace(handler.name), json.dumps(list(key)))
+        user_key = ("user_data", str(update.effective_user.id))
+        wanted = [
+            state_key for state_key in (conversation_key, user_key)
+            if state_key not in self.pending and state_key not in self.flushing
+        ]
+        if not wanted:
+            return
+        states = await self.db.load_states(wanted)
+        if user_key in wanted:
+            user_data.clear()
+            user_data.update(states.get(user_key) or {})
+        if conversation_key in wanted:
+            # PTB has no public way to reload a single conversation key
+            conversations = handler._conversations
+            state = states.get(conversation_key)
+            if state is None:
+                conversations.data.pop(key, None)
+            else:
+                conversations.update_no_track({key: state})
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        self._write(self._conversation_namespace(name), json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._write("user_data", str(user_id), data)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def drop_user_data(self, user_id):
+        self._write("user_data", str(user_id), None)
+
+    async def refresh_user_data(self, user_id, user_data):
+        # Done in refresh_session together with the conversation state
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # Only a timer that is still sleeping is cancelled
+        if self.flush_task and not self.flush_task.done():
+            self.flush_task.cancel()
+        await self._flush()
+
+class AcousticMatchBot:
+    def __init__(self, db=None):
+        self.db = db or Database()
+        self.notifier = NotificationDispatcher(self.db)
+        self.profile_edits = ProfileEditBuffer(self.db)
+
+    def update_metrics(self, application):
+        for name, value in self.db.cache.stats().items():
+            metrics.set(f"profile_cache_{name}", int(value))
+        for name, value in self.db.pool_status().items():
+            metrics.set(f"db_pool_{name}", int(value))
+        for name, value in self.notifier.stats().items():
+            metrics.set(f"notifications_{name}", value)
+        for index, replica in enumerate(self.db.replicas):
+            metrics.set("db_replica_healthy", int(replica.healthy), replica=str(index))
+            metrics.set("db_replica_lag_seconds", replica.lag or 0, replica=str(index))
+        metrics.set("update_queue_depth", application.update_queue.qsize())
+
+    async def health_status(self, application):
+        database_ok = await self.db.ping()
+        return database_ok, {
+            "status": "ok" if database_ok else "unavailable",
+            "database": dict(self.db.pool_status(), reachable=database_ok),
+            "replicas": self.db.replica_status(),
+            "profile_cache": self.db.cache.stats(),
+            "notifications": self.notifier.stats(),
+            "queues": {
+                "updates": application.update_queue.qsize(),
+                "notifications": self.notifier.queue.qsize()
+            }
+        }
+        
+    @instrumented
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        user_id = str(user.id)
+        
+        await self.db.register_user(user_id, {
+            "user_id": user_id,
+            "name": user.full_name,
+            "username": user.username,
+            "instruments": [],
+            "seeking": [],
+            "bio": "",
+            "created_at": datetime.now().isoformat()
+        })
+        
+        return await self.main_menu(update, context)
+
+    @instrumented
+    async def main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        keyboard = [
+            [InlineKeyboardButton("✏️ Edit Profile", callback_data="edit_profile")],
+            [InlineKeyboardButton("🔍 Find Collaborators", callback_data="browse_mode")],
+            [InlineKeyboardButton("👤 My Profile", callback_data="my_profile")],
+            [InlineKeyboardButton("🎶 My Matches", callback_data="my_matches")],
+            [InlineKeyboardButton("❓ Help", callback_data="help")]
+        ]
+        
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        if update.message:
+            await update.message.reply_text("🎸🎶 Hey there! This is Acoustic Night bot for collaborations! Click Help to find out more! 🌟:", reply_markup=reply_markup)
+        else:
+            await update.callback_query.edit_message_text("🎸🎶 Hey there! This is Acoustic Night bot for collaborations! Click Help to find out more! 🌟:", reply_markup=reply_markup)
+        return MAIN_MENU
+
+    @instrumented
+    async def show_my_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        user_id = str(query.from_user.id)
+        user_data = await self.db.get_user(user_id)
+        
+        profile_text = (
+            "👤 *Your Profile*\n\n"
+            f"🎻 Instruments: {', '.join(user_data['instruments']) or '-'}\n"
+            f"🔍 Seeking: {', '.join(user_data['seeking']) or '-'}\n"
+            f"📝 Bio: {user_data['bio'] or '-'}"
+        )
+        
+        await query.edit_message_text(
+            profile_text,
+            parse_mode="Markdown",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="back")]])
+        )
+        return MAIN_MENU
+
+    @instrumented
+    async def edit_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        
+        keyboard = [
+            [InlineKeyboardButton("🎻 My Instruments", callback_data="edit_instruments")],
+            [InlineKeyboardButton("🔍 Seeking", callback_data="edit_seeking")],
+            [InlineKeyboardButton("📝 Bio", callback_data="edit_bio")],
+            [InlineKeyboardButton("🔙 Back", callback_data="back")]
+        ]
+        
+        await query.edit_message_text(
+            "✏️ Edit Profile:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return EDIT_PROFILE
+
+    def category_picker(self, category, current_selection):
+        keyboard = []
+        
+        for instr in INSTRUMENTS:
+            status = "✅" if instr in current_selection else "◻️"
+            keyboard.append([InlineKeyboardButton(
+                f"{status} {instr.title()}",
+                callback_data=f"toggle_{category}_{instr}"
+            )])
+        
+        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
+        return f"Select your {category.replace('_', ' ')}:", InlineKeyboardMarkup(keyboard)
+
+    @instrumented
+    async def select_category(self, update: Update, context: ContextTypes.DEFAULT_TYPE, category: str):
+        query = update.callback_query
+        await query.answer()
+        user_id = str(query.from_user.id)
+        current_selection = self.profile_edits.selection(context.user_data, category)
+        if current_selection is None:
+            current_selection = (await self.db.get_user(user_id))[category]
+        
+        await self.profile_edits.render(user_id, query, *self.category_picker(category, current_selection))
+        return SELECT_INSTRUMENTS if category == "instruments" else SELECT_SEEKING
+
+    @instrumented
+    async def handle_toggle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        user_id = str(query.from_user.id)
+        _, category, instrument = query.data.split("_", 2)
+        if category not in PROFILE_CATEGORIES:
+            raise ValueError(f"Unknown profile category: {category}")
+        
+        # Taps only touch the buffer; the row is written once on Back
+        current_user = None
+        if self.profile_edits.selection(context.user_data, category) is None:
+            current_user = await self.db.get_user(user_id)
+        selection = self.profile_edits.toggle(user_id, context, current_user, category, instrument)
+        self.profile_edits.render_later(user_id, query, *self.category_picker(category, selection))
+        return SELECT_INSTRUMENTS if category == "instruments" else SELECT_SEEKING
+
+    @instrumented
+    async def finish_selection(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await self.profile_edits.flush(str(update.effective_user.id), context.user_data)
+        return await self.edit_profile(update, context)
+
+    @instrumented
+    async def request_bio(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        await query.edit_message_text(
+            "📝 Please write a short bio (max 120 characters):\n\n"
+            "Example:\n"
+            "\"Guitarist looking for vocalist to create acoustic covers. "
+            "Available weekends. Love rock and pop!\""
+        )
+        return WRITE_BIO
+
+    @instrumented
+    async def save_bio(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = str(update.effective_user.id)
+        bio = update.message.text
+        
+        if len(bio) > 120:
+            await update.message.reply_text("❌ Bio is too long! Maximum 120 characters.")
+            return WRITE_BIO
+            
+        await self.db.set_bio(user_id, bio)
+        await update.message.reply_text("✅ Bio saved successfully!")
+        return await self.main_menu(update, context)
+
+    @instrumented
+    async def browse_mode(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        
+        if not await self.db.has_other_users(str(query.from_user.id)):
+            await query.edit_message_text("😢 No other profiles available yet!")
+            return await self.main_menu(update, context)
+        
+        keyboard = [
+            [InlineKeyboardButton("🎯 Smart Matches", callback_data="smart")],
+            [InlineKeyboardButton("🔀 Browse All", callback_data="all")],
+            [InlineKeyboardButton("🔎 Search", callback_data="search")],
+            [InlineKeyboardButton("🔙 Back", callback_data="back")]
+        ]
+        
+        await query.edit_message_text(
+            "🔍 Choose browsing mode:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return BROWSE_MODE
+
+    @instrumented
+    async def prepare_browsing(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        user_id = str(query.from_user.id)
+        mode = query.data
+        current_user = await self.db.get_user(user_id)
+        
+        # The session only holds a keyset window of candidate ids; profiles
+        # are fetched page by page as the user moves through it
+        candidate_ids = await self.db.find_candidate_ids(current_user, mode)
+        if not candidate_ids:
+            await query.edit_message_text("😢 No matching profiles found!")
+            return await self.main_menu(update, context)
+        
+        context.user_data["browse"] = {
+            "mode": mode,
+            "ids": candidate_ids,
+            "offset": 0,
+            "total": await self.db.count_candidates(current_user, mode)
+        }
+        context.user_data["current_index"] = 0
+        return await self.show_profile(update, context)
+
+    @instrumented
+    async def request_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        await query.edit_message_text(
+            "🔎 What are you looking for? Words are matched against names, instruments and bios.\n\n"
+            "Example: fingerstyle guitarist jazz"
+        )
+        return SEARCH_QUERY
+
+    @instrumented
+    async def search_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not context.args:
+            await update.message.reply_text("🔎 What are you looking for? Example: fingerstyle guitarist jazz")
+            return SEARCH_QUERY
+        return await self.start_search(update, context, " ".join(context.args))
+
+    @instrumented
+    async def run_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await self.start_search(update, context, update.message.text)
+
+    async def start_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+        user_id = str(update.effective_user.id)
+        current_user = await self.db.get_user(user_id)
+        if current_user is None:
+            return await self.start(update, context)
+        
+        keys = await self.db.search_candidates(current_user, text)
+        if not keys:
+            await update.message.reply_text(f"😢 No profiles match \"{text}\"")
+            return await self.main_menu(update, context)
+        
+        context.user_data["browse"] = {
+            "mode": "search",
+            "query": text,
+            "keys": keys,
+            "ids": [user_id for _, user_id in keys],
+            "offset": 0,
+            "total": await self.db.count_candidates(current_user, "search", query=text)
+        }
+        context.user_data["current_index"] = 0
+        return await self.show_profile(update, context)
+
+    async def candidate_window(self, current_user, session, after=None, before=None):
+        if session["mode"] != "search":
+            return await self.db.find_candidate_ids(current_user, session["mode"], after=after, before=before)
+        # Search pages are anchored on the stored (rank, user_id) key rather
+        # than on the boundary profile, which may no longer match the query
+        keys = session["keys"]
+        session["keys"] = await self.db.search_candidates(
+            current_user, session["query"],
+            after=keys[-1] if after is not None else None,
+            before=keys[0] if before is not None else None
+        )
+        return [user_id for _, user_id in session["keys"]]
+
+    async def load_candidate(self, current_user, session, index):
+        ids = session["ids"]
+        if ids and index < session["offset"]:
+            ids = await self.candidate_window(current_user, session, before=ids[0])
+            session["offset"] = index - len(ids) + 1
+        elif ids and index >= session["offset"] + len(ids):
+            ids = await self.candidate_window(current_user, session, after=ids[-1])
+            session["offset"] = index
+        session["ids"] = ids
+        
+        position = index - session["offset"]
+        if not 0 <= position < len(ids):
+            return None
+        profiles = await self.db.get_users(ids[position:position + 1 + BROWSE_PREFETCH])
+        return next((profile for profile in profiles if profile["user_id"] == ids[position]), None)
+
+    @instrumented
+    async def show_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = str(update.effective_user.id)
+        session = context.user_data["browse"]
+        index = context.user_data["current_index"]
+        current_user = await self.db.get_user(user_id)
+        
+        profile = await self.load_candidate(current_user, session, index) if index >= 0 else None
+        if profile is None:
+            await update.callback_query.edit_message_text("🏁 You've viewed all profiles!")
+            return await self.main_menu(update, context)
+        
+        session["profile_id"] = profile["user_id"]
+        session["total"] = max(session["total"], index + 1)
+        is_match = await self.db.view_profile(user_id, profile["user_id"])
+        contact = f"@{profile['username']}" if (is_match and profile.get("username")) else "🔒 Contact hidden until mutual match"
+
+        keyboard = []
+        if index > 0:
+            keyboard.append([InlineKeyboardButton("⬅️ Previous", callback_data="previous")])
+        
+        if not is_match:
+            keyboard.append([
+                InlineKeyboardButton("🎵 Let's Collab", callback_data="like"),
+                InlineKeyboardButton("➡️ Next", callback_data="next")
+            ])
+        else:
+            keyboard.append([InlineKeyboardButton("➡️ Next", callback_data="next")])
+        
+        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
+        
+        text = (
+            f"🎸 Profile {index+1}/{session['total']}\n\n"
+            f"👤 Name: {profile['name']}\n"
+            f"📞 Contact: {contact}\n"
+            f"🎻 Instruments: {', '.join(profile['instruments'])}\n"
+            f"🔍 Seeking: {', '.join(profile['seeking'])}\n"
+            f"📝 Bio: {profile['bio']}"
+        )
+        
+        if update.message:
+            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        else:
+            await update.callback_query.edit_message_text(
+                text,
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        return BROWSE_PROFILES
+
+    @instrumented
+    async def handle_navigation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        action = query.data
+        
+        if action == "previous":
+            context.user_data["current_index"] -= 1
+        elif action == "next":
+            context.user_data["current_index"] += 1
+        
+        return await self.show_profile(update, context)
+
+    @instrumented
+    async def handle_like(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        user_id = str(query.from_user.id)
+        target_id = context.user_data["browse"]["profile_id"]
+        
+        if not await self.db.add_pending(user_id, target_id):
+            await query.answer("Request already pending!")
+            return BROWSE_PROFILES
+        current_user = await self.db.get_user(user_id)
+        
+        keyboard = [
+            [InlineKeyboardButton("✅ Accept", callback_data=f"accept_{user_id}"),
+             InlineKeyboardButton("❌ Decline", callback_data=f"decline_{user_id}")]
+        ]
+        await self.notifier.enqueue(
+            target_id,
+            f"🎵 New collaboration request from {current_user['name']}!\n\n"
+            f"View their profile and respond:",
+            InlineKeyboardMarkup(keyboard)
+        )
+        
+        await query.answer("Request sent!")
+        context.user_data["current_index"] += 1
+        return await self.show_profile(update, context)
+
+    @instrumented
+    async def handle_response(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        user_id = str(query.from_user.id)
+        action, sender_id = query.data.split("_")
+        
+        if action == "accept":
+            result = await self.db.accept_match(user_id, sender_id)
+            if result is None:
+                await query.answer("This request is no longer available")
+                return MAIN_MENU
+            _, sender_data = result
+            
+            contact = f"@{sender_data['username']}" if sender_data.get("username") else "⚠️ No username set"
+            text = (
+                f"🎉 New Collaboration Partner!\n\n"
+                f"👤 Name: {sender_data['name']}\n"
+                f"📞 Contact: {contact}\n"
+                f"🎻 Instruments: {', '.join(sender_data['instruments'])}\n"
+                f"🔍 Seeking: {', '.join(sender_data['seeking'])}\n"
+                f"📝 Bio: {sender_data['bio']}"
+            )
+            await query.edit_message_text(text)
+            await query.answer("Match accepted!")
+        else:
+            await self.db.remove_pending(sender_id, user_id)
+            await query.answer("Request declined")
+            await query.message.delete()
+        
+        return MAIN_MENU
+
+    @instrumented
+    async def show_matches(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        user_id = str(query.from_user.id)
+        current_user = await self.db.get_user(user_id)
+        
+        matches = await self.db.get_edges(user_id, "match")
+        smart_matches = await self.db.get_smart_match_ids(current_user)
+        
+        all_matches = matches + [match for match in smart_matches if match not in matches]
+        
+        if not all_matches:
+            await query.answer("You have no matches yet 😢")
+            return MAIN_MENU
+        
+        pages = (len(all_matches) + MATCHES_PAGE_SIZE - 1) // MATCHES_PAGE_SIZE
+        page = 0
+        if query.data.startswith("matches_page_"):
+            page = min(int(query.data.rsplit("_", 1)[1]), pages - 1)
+        start = page * MATCHES_PAGE_SIZE
+        
+        matches_text = f"🎶 Your Matches ({page+1}/{pages}):\n\n"
+        for match in await self.db.get_users(all_matches[start:start + MATCHES_PAGE_SIZE]):
+            contact = f"@{match['username']}" if match.get("username") else "⚠️ No username set"
+            matches_text += (
+                f"👤 {match.get('name', 'Anonymous')}\n"
+                f"🎻 Instruments: {', '.join(match.get('instruments', []))}\n"
+                f"📞 Contact: {contact}\n\n"
+            )
+        
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️ Previous", callback_data=f"matches_page_{page-1}"))
+        if page < pages - 1:
+            navigation.append(InlineKeyboardButton("➡️ Next", callback_data=f"matches_page_{page+1}"))
+        reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+        
+        if query.data.startswith("matches_page_"):
+            await query.answer()
+            await query.edit_message_text(matches_text, reply_markup=reply_markup)
+        else:
+            await query.message.reply_text(matches_text, reply_markup=reply_markup)
+        return MAIN_MENU
+
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in ADMIN_IDS:
+            return
+        if context.args and context.args[0] == "stop":
+            if profiler.profile is None:
+                await update.message.reply_text("No profiling in progress")
+                return
+            path = profiler.stop()
+            await update.message.reply_text(f"Profile written to {path}" if path else "Failed to write the profile, see the log")
+            return
+        try:
+            minutes = float(context.args[0]) if context.args else 5
+        except ValueError:
+            await update.message.reply_text("Usage: /profile <minutes> | /profile stop")
+            return
+        path = os.path.join(PROFILE_DIR, f"handlers-{datetime.now():%Y%m%d-%H%M%S}.prof")
+        if profiler.start(minutes, path):
+            await update.message.reply_text(f"Profiling {PROFILE_SAMPLE_RATE:.0%} of updates for {minutes:g} min into {path}")
+        else:
+            await update.message.reply_text("Profiling is already running")
+
+    @instrumented
+    async def help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.message.reply_text(
+            HELP_TEXT,
+            parse_mode="Markdown",
+            disable_web_page_preview=True
+        )
+        return await self.main_menu(update, context)
+
+async def run_webhook(application):
+    webhook_url = os.getenv("WEBHOOK_URL")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if webhook_url:
+        await application.bot.set_webhook(
+            url=webhook_url.rstrip("/") + os.getenv("WEBHOOK_PATH", "/telegram"),
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        logger.warning("WEBHOOK_URL is not set; accepting locally posted updates only")
+    await application.start()
+    try:
+        await stop.wait()
+    finally:
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+def build_application(bot, builder, persistence=None, application_class=BotApplication, concurrency=CONCURRENT_UPDATES):
+    if persistence:
+        builder = builder.persistence(persistence)
+    if concurrency > 1:
+        # PTB starts a task per update whatever the limit, so this only
+        # decides where updates wait; see BotApplication
+        builder = builder.concurrent_updates(sys.maxsize)
+    application = builder.application_class(application_class).build()
+    application.dispatch_slots = asyncio.Semaphore(concurrency)
+
+    # Регистрация обработчиков
+    conv_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler("start", bot.start),
+            CommandHandler("search", bot.search_command)
+        ],
+        states={
+            MAIN_MENU: [
+                CallbackQueryHandler(bot.edit_profile, pattern="^edit_profile$"),
+                CallbackQueryHandler(bot.browse_mode, pattern="^browse_mode$"),
+                CallbackQueryHandler(bot.show_my_profile, pattern="^my_profile$"),
+                CallbackQueryHandler(bot.show_matches, pattern="^my_matches$"),
+                CallbackQueryHandler(bot.help, pattern="^help$"),
+                CallbackQueryHandler(bot.main_menu, pattern="^back$")
+            ],
+            EDIT_PROFILE: [
+                CallbackQueryHandler(lambda u,c: bot.select_category(u, c, "instruments"), pattern="^edit_instruments$"),
+                CallbackQueryHandler(lambda u,c: bot.select_category(u, c, "seeking"), pattern="^edit_seeking$"),
+                CallbackQueryHandler(bot.request_bio, pattern="^edit_bio$"),
+                CallbackQueryHandler(bot.main_menu, pattern="^back$")
+            ],
+            SELECT_INSTRUMENTS: [
+                CallbackQueryHandler(bot.handle_toggle, pattern=r"^toggle_instruments_"),
+                CallbackQueryHandler(bot.finish_selection, pattern="^back$")
+            ],
+            SELECT_SEEKING: [
+                CallbackQueryHandler(bot.handle_toggle, pattern=r"^toggle_seeking_"),
+                CallbackQueryHandler(bot.finish_selection, pattern="^back$")
+            ],
+            WRITE_BIO: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.save_bio)
+            ],
+            BROWSE_MODE: [
+                CallbackQueryHandler(bot.prepare_browsing, pattern="^(smart|all)$"),
+                CallbackQueryHandler(bot.request_search, pattern="^search$"),
+                CallbackQueryHandler(bot.main_menu, pattern="^back$")
+            ],
+            BROWSE_PROFILES: [
+                CallbackQueryHandler(bot.handle_navigation, pattern="^(previous|next)$"),
+                CallbackQueryHandler(bot.handle_like, pattern="^like$"),
+                CallbackQueryHandler(bot.main_menu, pattern="^back$")
+            ],
+            SEARCH_QUERY: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, bot.run_search)
+            ]
+        },
+        fallbacks=[
+            CommandHandler("start", bot.start),
+            CommandHandler("search", bot.search_command)
+        ],
+        per_message=False,
+        name="acoustic_match",
+        persistent=persistence is not None
+    )
+
+    # Общее состояние диалога: перечитываем его перед обработкой каждого обновления
+    if persistence:
+        async def refresh_state(update, context):
+            await persistence.refresh_session(conv_handler, update, context.user_data)
+
+        application.add_handler(TypeHandler(Update, refresh_state), group=-1)
+    application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(bot.handle_response, pattern=r"^(accept|decline)_"))
+    application.add_handler(CallbackQueryHandler(bot.show_matches, pattern=r"^matches_page_\d+$"))
+    application.add_handler(CommandHandler("profile", bot.profile_command))
+    return application
+
+def main():
+    # Инициализация бота
+    bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    bot_mode = os.getenv("BOT_MODE", "polling")
+    if bot_mode == "webhook" and not os.getenv("WEBHOOK_SECRET"):
+        # The webhook route listens on every interface, so without a secret
+        # anyone who can reach PORT could post forged updates
+        raise RuntimeError("WEBHOOK_SECRET must be set when BOT_MODE is webhook")
+    bot = AcousticMatchBot()
+    http_server = HttpServer(int(os.getenv('PORT', 10000)))
+    persistence = PostgresPersistence(bot.db) if os.getenv("PERSISTENCE", "postgres") == "postgres" else None
+
+    async def startup(application):
+        application.create_task(bot.db.backfill_instrument_columns())
+        await bot.profile_edits.recover()
+        await bot.db.start_replica_monitor()
+        await bot.db.start_cache_invalidation()
+        await bot.notifier.start(application.bot)
+        await http_server.start()
+
+    async def stop(application):
+        # Runs before PTB's final persistence flush
+        await bot.profile_edits.stop()
+
+    async def shutdown(application):
+        profiler.stop()
+        await http_server.stop()
+        await bot.notifier.stop()
+        await bot.db.stop_replica_monitor()
+        await bot.db.stop_cache_invalidation()
+        bot.db.close()
+
+    builder = (
+        Application.builder()
+        .token(bot_token)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(startup)
+        .post_stop(stop)
+        .post_shutdown(shutdown)
+    )
+    application = build_application(bot, builder, persistence)
+
+    # HTTP: health check всегда, обновления Telegram только в режиме webhook
+    async def health(headers, body):
+        ready, status = await bot.health_status(application)
+        return (200 if ready else 503), "application/json", json.dumps(status).encode()
+
+    async def webhook(headers, body):
+        if not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), os.getenv("WEBHOOK_SECRET")):
+            return 403, "text/plain", b"Forbidden"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Bad webhook update: {str(e)}")
+            return 400, "text/plain", b"Bad Request"
+        await application.update_queue.put(update)
+        return 200, "text/plain", b"OK"
+
+    async def metrics_endpoint(headers, body):
+        bot.update_metrics(application)
+        return 200, "text/plain; version=0.0.4", metrics.render().encode()
+
+    http_server.route("GET", "/", health)
+    http_server.route("GET", "/health", health)
+    http_server.route("GET", "/metrics", metrics_endpoint)
+    if bot_mode == "webhook":
+        http_server.route("POST", os.getenv("WEBHOOK_PATH", "/telegram"), webhook)
+
+    # Запуск бота
+    if bot_mode == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
+
+async def run_admin_command(args):
+    db = Database()
+    try:
+        if args.command == "count":
+            print(await db.count_users())
+        elif args.command == "export":
+            out = open(args.path, "w", encoding="utf-8") if args.path != "-" else sys.stdout
+            try:
+                exported = await db.export_users(out, rewindable=out is not sys.stdout)
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+            logger.info(f"Exported {exported} users")
+        elif args.command == "import":
+            source = open(args.path, encoding="utf-8") if args.path != "-" else sys.stdin
+            try:
+                imported = await db.import_users(source, rewindable=source is not sys.stdin)
+            finally:
+                if source is not sys.stdin:
+                    source.close()
+            logger.info(f"Imported {imported} users")
+    finally:
+        db.close()
+
+def admin():
+    parser = argparse.ArgumentParser(description="AcousticMatchBot maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("count", help="print the number of registered users")
+    commands.add_parser("export", help="stream all profiles as NDJSON").add_argument("path", nargs="?", default="-")
+    commands.add_parser("import", help="upsert profiles from NDJSON").add_argument("path", nargs="?", default="-")
+    asyncio.run(run_admin_command(parser.parse_args()))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        admin()
+    else:
+        main()
@@ -0,0 +1,607 @@
+import argparse
+import asyncio
+import bisect
+import copy
+import heapq
+import json
+import logging
+import random
+import re
+import sys
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+
+from TelegaBot import (
+    INSTRUMENTS,
+    NOTIFY_CLAIM_LEASE,
+    PROFILE_CATEGORIES,
+    SMART_MATCH_LIMIT,
+    AcousticMatchBot,
+    ProfileCache,
+    percentile
+)
+
+WORDS = [
+    "acoustic", "covers", "jazz", "folk", "rock", "pop", "blues", "fingerstyle",
+    "weekends", "harmonies", "originals", "indie", "soul", "jam", "duo", "band",
+    "evenings", "unplugged", "ballads", "songwriting", "groove", "latin", "gospel"
+]
+SEARCH_WEIGHTS = {"name": 1.0, "instruments": 1.0, "bio": 0.4}
+FIRST_NAMES = ["Alex", "Sam", "Jordan", "Taylor", "Robin", "Kim", "Max", "Sasha", "Nika", "Lee"]
+LAST_NAMES = ["Ivanova", "Smith", "Garcia", "Kowalski", "Novak", "Berg", "Rossi", "Chen", "Lopez", "Petrov"]
+
+def generate_profiles(count, seed=0):
+    rng = random.Random(seed)
+    profiles = []
+    for i in range(count):
+        user_id = str(100000000 + i)
+        profiles.append({
+            "user_id": user_id,
+            "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            "username": f"musician{i}" if rng.random() < 0.8 else None,
+            "instruments": rng.sample(INSTRUMENTS, rng.randint(1, 3)),
+            "seeking": rng.sample(INSTRUMENTS, rng.randint(1, 3)),
+            "bio": " ".join(rng.sample(WORDS, rng.randint(4, 10)))[:120],
+            "created_at": "2024-01-01T00:00:00"
+        })
+    return profiles
+
+class MemoryDatabase:
+    # Local stand-in for Database with the same coroutine interface. Documents
+    # are stored as JSON text so every read pays the decode cost a real row would.
+    def __init__(self, profiles=()):
+        self.rows = {}
+        self.docs = {}
+        self.ids = []
+        self.notifications = {}
+        self.next_notification_id = 1
+        self.states = {}
+        self.smart_matches = {}
+        self.outgoing = defaultdict(dict)
+        self.incoming = defaultdict(dict)
+        self.terms = {}
+        self.postings = defaultdict(dict)
+        self.ranked = defaultdict(list)
+        self.calls = Counter()
+        self.cache = ProfileCache(maxsize=0)
+        for profile in profiles:
+            self._store(profile)
+
+    def _store(self, data):
+        user_id = data["user_id"]
+        if user_id not in self.rows:
+            bisect.insort(self.ids, user_id)
+        self.rows[user_id] = json.dumps(data, default=str)
+        self.docs[user_id] = data
+        self._index(user_id, data)
+
+    def _tokens(self, text):
+        return re.findall(r"\w+", text.lower())
+
+    def _index(self, user_id, data):
+        # Stand-in for the users.search GIN index so the search handlers can
+        # be driven without PostgreSQL. Scores are a plain sum of per-field
+        # weights, not ts_rank_cd, so its timings say nothing about the
+        # production query; loadtest.py --postgres exercises that one.
+        terms = {}
+        for field, weight in SEARCH_WEIGHTS.items():
+            value = data.get(field) or ""
+            text = " ".join(value) if isinstance(value, list) else value
+            for token in self._tokens(text):
+                terms[token] = terms.get(token, 0.0) + weight
+        previous = self.terms.get(user_id, {})
+        for token, weight in previous.items():
+            if terms.get(token) != weight:
+                del self.postings[token][user_id]
+                ranked = self.ranked[token]
+                del ranked[bisect.bisect_left(ranked, (-weight, user_id))]
+        for token, weight in terms.items():
+            if previous.get(token) != weight:
+                self.postings[token][user_id] = weight
+                bisect.insort(self.ranked[token], (-weight, user_id))
+        self.terms[user_id] = terms
+
+    def _search_matches(self, query):
+        tokens = set(self._tokens(query))
+        if not tokens:
+            return [], set()
+        lists = sorted((self.postings.get(token, {}) for token in tokens), key=len)
+        if len(lists) == 1:
+            return lists, lists[0].keys()
+        first, second, *rest = lists
+        matches = {user_id for user_id in first if user_id in second}
+        for postings in rest:
+            matches = {user_id for user_id in matches if user_id in postings}
+        return lists, matches
+
+    def _search(self, user, query, after, before, limit):
+        # Keys are (-score, user_id) internally and [score, user_id] outside,
+        # like the (rank, user_id) keys Database.search_candidates returns
+        after = (-after[0], after[1]) if after is not None else None
+        before = (-before[0], before[1]) if before is not None else None
+        tokens = set(self._tokens(query))
+        if len(tokens) == 1:
+            keys = self._search_term(user, tokens.pop(), after, before, limit)
+        else:
+            lists, matches = self._search_matches(query)
+            scored = [
+                (-sum(postings[user_id] for postings in lists), user_id)
+                for user_id in matches if user_id != user["user_id"]
+            ]
+            if after is not None:
+                keys = heapq.nsmallest(limit, (key for key in scored if key > after))
+            elif before is not None:
+                keys = sorted(heapq.nlargest(limit, (key for key in scored if key < before)))
+            else:
+                keys = heapq.nsmallest(limit, scored)
+        return [[-score, user_id] for score, user_id in keys]
+
+    def _search_term(self, user, token, after, before, limit):
+        ranked = self.ranked.get(token, [])
+        if before is not None:
+            end = bisect.bisect_left(ranked, before)
+            page = ranked[max(0, end - limit - 1):end]
+            return [key for key in page if key[1] != user["user_id"]][-limit:]
+        start = bisect.bisect_right(ranked, after) if after is not None else 0
+        page = ranked[start:start + limit + 1]
+        return [key for key in page if key[1] != user["user_id"]][:limit]
+
+    def _load(self, user_id):
+        row = self.rows.get(user_id)
+        return json.loads(row) if row is not None else None
+
+    def _update(self, name, user_id, change):
+        self.calls[name] += 1
+        data = self._load(user_id)
+        if data is None or change(data) is False:
+            return None
+        self._store(data)
+        return copy.deepcopy(data)
+
+    def _matches(self, user, data, mode):
+        if data["user_id"] == user["user_id"]:
+            return False
+        if mode != "smart":
+            return not self._has_edge(user["user_id"], "pending", data["user_id"])
+        return (
+            any(instr in data["instruments"] for instr in user["seeking"]) and
+            any(instr in user["instruments"] for instr in data["seeking"])
+        )
+
+    def _score(self, user, data):
+        return (
+            sum(1 for instr in data["instruments"] if instr in user["seeking"]) +
+            sum(1 for instr in data["seeking"] if instr in user["instruments"])
+        )
+
+    def _rank(self, user, candidate_ids):
+        scored = sorted((-self._score(user, self.docs[user_id]), user_id) for user_id in candidate_ids)
+        return [user_id for _, user_id in scored[:SMART_MATCH_LIMIT]]
+
+    def _has_edge(self, src, kind, dst):
+        return dst in self.outgoing.get((src, kind), ())
+
+    def _add_edge(self, src, kind, dst):
+        if self._has_edge(src, kind, dst):
+            return False
+        self.outgoing[(src, kind)][dst] = None
+        self.incoming[(dst, kind)][src] = None
+        return True
+
+    def _remove_edge(self, src, kind, dst):
+        if not self._has_edge(src, kind, dst):
+            return False
+        del self.outgoing[(src, kind)][dst]
+        del self.incoming[(dst, kind)][src]
+        return True
+
+    def pool_status(self):
+        return {"size": 0, "in_use": 0, "idle": 0, "closed": False}
+
+    def close(self):
+        pass
+
+    async def ping(self):
+        return True
+
+    async def get_user(self, user_id):
+        self.calls["get_user"] += 1
+        return self._load(user_id)
+
+    async def get_users(self, user_ids):
+        self.calls["get_users"] += 1
+        return [self._load(user_id) for user_id in user_ids if user_id in self.rows]
+
+    async def iter_users(self, batch_size=1000):
+        self.calls["iter_users"] += 1
+        for start in range(0, len(self.ids), batch_size):
+            for user_id in self.ids[start:start + batch_size]:
+                yield self._load(user_id)
+
+    async def count_users(self):
+        self.calls["count_users"] += 1
+        return len(self.ids)
+
+    async def has_other_users(self, user_id):
+        self.calls["has_other_users"] += 1
+        return len(self.ids) > (1 if user_id in self.rows else 0)
+
+    async def register_user(self, user_id, data):
+        self.calls["register_user"] += 1
+        existing = self._load(user_id)
+        if existing is not None:
+            existing.update({"name": data["name"], "username": data["username"]})
+            data = existing
+        self._store(copy.deepcopy(data))
+        return data
+
+    async def set_items(self, user_id, items, session_version=None):
+        self.calls["set_items"] += 1
+        if session_version is not None:
+            key = ("user_data", str(user_id))
+            session = json.loads(self.states.get(key, "{}"))
+            if "profile_edit" not in session or session.get("profile_edit_version", 0) != session_version:
+                return None
+            session.pop("profile_edit")
+            session.pop("profile_edit_version", None)
+            self.states[key] = json.dumps(session, default=str)
+        data = self._load(user_id)
+        if data is None:
+            return None
+        data.update(copy.deepcopy(items))
+        self._store(data)
+        self._refresh_smart_matches(data)
+        return copy.deepcopy(data)
+
+    async def set_bio(self, user_id, bio):
+        return self._update("set_bio", user_id, lambda data: data.update(bio=bio))
+
+    async def add_pending(self, user_id, target_id):
+        self.calls["add_pending"] += 1
+        return self._add_edge(user_id, "pending", target_id)
+
+    async def remove_pending(self, user_id, target_id):
+        self.calls["remove_pending"] += 1
+        return self._remove_edge(user_id, "pending", target_id)
+
+    async def view_profile(self, user_id, profile_id):
+        self.calls["view_profile"] += 1
+        self._add_edge(user_id, "viewed", profile_id)
+        return self._has_edge(user_id, "match", profile_id)
+
+    async def get_edges(self, user_id, kind, incoming=False):
+        self.calls["get_edges"] += 1
+        return list((self.incoming if incoming else self.outgoing).get((user_id, kind), ()))
+
+    async def accept_match(self, user_id, sender_id):
+        self.calls["accept_match"] += 1
+        current_user, sender_data = self._load(user_id), self._load(sender_id)
+        if current_user is None or sender_data is None or not self._remove_edge(sender_id, "pending", user_id):
+            return None
+        self._remove_edge(user_id, "pending", sender_id)
+        self._add_edge(user_id, "match", sender_id)
+        self._add_edge(sender_id, "match", user_id)
+        return current_user, sender_data
+
+    async def get_smart_match_ids(self, user):
+        self.calls["get_smart_match_ids"] += 1
+        user_id = user["user_id"]
+        if user_id not in self.smart_matches:
+            self.smart_matches[user_id] = self._rank(user, [
+                candidate_id for candidate_id in self.ids
+                if self._matches(user, self.docs[candidate_id], "smart")
+            ])
+        return sorted(self.smart_matches[user_id], key=lambda candidate_id: (
+            self._has_edge(user_id, "pending", candidate_id),
+            self._has_edge(user_id, "viewed", candidate_id)
+        ))
+
+    def _refresh_smart_matches(self, user):
+        user_id = user["user_id"]
+        self.smart_matches.pop(user_id, None)
+        for owner_id, ranked in self.smart_matches.items():
+            owner = self.docs[owner_id]
+            candidates = [candidate_id for candidate_id in ranked if candidate_id != user_id]
+            if self._matches(owner, user, "smart"):
+                candidates.append(user_id)
+            self.smart_matches[owner_id] = self._rank(owner, candidates)
+
+    async def search_candidates(self, user, query, after=None, before=None, limit=20):
+        self.calls["search_candidates"] += 1
+        return self._search(user, query, after, before, limit)
+
+    async def find_candidate_ids(self, user, mode, after=None, before=None, limit=20):
+        self.calls["find_candidate_ids"] += 1
+        if mode == "smart":
+            return await self.get_smart_match_ids(user) if after is None and before is None else []
+        if before is not None:
+            found = []
+            for user_id in reversed(self.ids[:bisect.bisect_left(self.ids, before)]):
+                if self._matches(user, self.docs[user_id], mode):
+                    found.append(user_id)
+                    if len(found) == limit:
+                        break
+            return found[::-1]
+        found = []
+        start = bisect.bisect_right(self.ids, after) if after is not None else 0
+        for user_id in self.ids[start:]:
+            if self._matches(user, self.docs[user_id], mode):
+                found.append(user_id)
+                if len(found) == limit:
+                    break
+        return found
+
+    async def count_candidates(self, user, mode, query=None):
+        self.calls["count_candidates"] += 1
+        if mode == "search":
+            _, matches = self._search_matches(query)
+            return len(matches) - (user["user_id"] in matches)
+        if mode == "smart":
+            return len(await self.get_smart_match_ids(user))
+        return sum(1 for user_id in self.ids if self._matches(user, self.docs[user_id], mode))
+
+    async def load_states(self, keys):
+        self.calls["load_states"] += 1
+        return {key: json.loads(self.states[key]) for key in keys if key in self.states}
+
+    async def save_states(self, states):
+        self.calls["save_states"] += 1
+        for key, data in states.items():
+            if data is None:
+                self.states.pop(key, None)
+            else:
+                self.states[key] = json.dumps(data, default=str)
+        return True
+
+    async def add_notification(self, chat_id, text, reply_markup=None):
+        self.calls["add_notification"] += 1
+        notification_id = self.next_notification_id
+        self.next_notification_id += 1
+        self.notifications[notification_id] = {
+            "id": notification_id,
+            "chat_id": chat_id,
+            "text": text,
+            "reply_markup": reply_markup,
+            "claimed_until": time.monotonic() + NOTIFY_CLAIM_LEASE
+        }
+        return notification_id
+
+    async def delete_notification(self, notification_id):
+        self.calls["delete_notification"] += 1
+        self.notifications.pop(notification_id, None)
+
+    async def claim_notifications(self, held_ids=(), limit=100):
+        self.calls["claim_notifications"] += 1
+        now = time.monotonic()
+        for notification_id in held_ids:
+            if notification_id in self.notifications:
+                self.notifications[notification_id]["claimed_until"] = now + NOTIFY_CLAIM_LEASE
+        claimed = []
+        for notification in self.notifications.values():
+            if len(claimed) >= limit:
+                break
+            if notification["claimed_until"] < now:
+                notification["claimed_until"] = now + NOTIFY_CLAIM_LEASE
+                claimed.append({key: value for key, value in notification.items() if key != "claimed_until"})
+        return claimed
+
+class FakeUser:
+    def __init__(self, user_id, full_name="Bench User", username=None):
+        self.id = int(user_id)
+        self.full_name = full_name
+        self.username = username
+
+class FakeMessage:
+    def __init__(self, text=None):
+        self.text = text
+        self.message_id = 1
+
+    async def reply_text(self, text, **kwargs):
+        return FakeMessage(text)
+
+    async def delete(self):
+        return True
+
+class FakeCallbackQuery:
+    def __init__(self, user, data):
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage()
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+    async def edit_message_text(self, text, **kwargs):
+        return FakeMessage(text)
+
+class FakeUpdate:
+    def __init__(self, user, data=None, text=None):
+        self.effective_user = user
+        self.callback_query = FakeCallbackQuery(user, data) if data is not None else None
+        self.message = FakeMessage(text) if text is not None else None
+
+class FakeBot:
+    async def send_message(self, chat_id, text, **kwargs):
+        return FakeMessage(text)
+
+class FakeApplication:
+    # The driver keeps sessions in memory only
+    persistence = None
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.application = FakeApplication()
+        self.user_data = {}
+        self.args = []
+
+class HandlerDriver:
+    def __init__(self, profiles, seed=0):
+        self.db = MemoryDatabase(profiles)
+        self.bot = AcousticMatchBot(self.db)
+        self.fake_bot = FakeBot()
+        self.contexts = {}
+        self.rng = random.Random(seed)
+        self.user_ids = [profile["user_id"] for profile in profiles]
+
+    def context(self, user_id):
+        if user_id not in self.contexts:
+            self.contexts[user_id] = FakeContext(self.fake_bot)
+        return self.contexts[user_id]
+
+    def random_user(self):
+        return self.rng.choice(self.user_ids)
+
+    async def click(self, user_id, data):
+        update = FakeUpdate(FakeUser(user_id), data=data)
+        return update, self.context(user_id)
+
+    async def browse_mode(self, user_id):
+        update, context = await self.click(user_id, "browse_mode")
+        return await self.bot.browse_mode(update, context)
+
+    async def scan_users(self):
+        count = 0
+        async for _ in self.db.iter_users():
+            count += 1
+        return count
+
+    async def search(self, user_id):
+        update = FakeUpdate(FakeUser(user_id), text="/search")
+        context = self.context(user_id)
+        context.args = self.rng.sample(WORDS + INSTRUMENTS, self.rng.randint(1, 2))
+        return await self.bot.search_command(update, context)
+
+    async def browse(self, user_id, mode):
+        update, context = await self.click(user_id, mode)
+        return await self.bot.prepare_browsing(update, context)
+
+    async def next_profile(self, user_id):
+        context = self.context(user_id)
+        if "browse" not in context.user_data:
+            await self.browse(user_id, "all")
+        update, context = await self.click(user_id, "next")
+        return await self.bot.handle_navigation(update, context)
+
+    async def like(self, user_id):
+        context = self.context(user_id)
+        if "browse" not in context.user_data:
+            await self.browse(user_id, "all")
+        update, context = await self.click(user_id, "like")
+        return await self.bot.handle_like(update, context)
+
+    async def toggle(self, user_id):
+        category = self.rng.choice(PROFILE_CATEGORIES)
+        update, context = await self.click(user_id, f"toggle_{category}_{self.rng.choice(INSTRUMENTS)}")
+        return await self.bot.handle_toggle(update, context)
+
+    async def finish_selection(self, user_id):
+        update, context = await self.click(user_id, "back")
+        return await self.bot.finish_selection(update, context)
+
+    async def matches(self, user_id):
+        update, context = await self.click(user_id, "my_matches")
+        return await self.bot.show_matches(update, context)
+
+OPERATIONS = {
+    "prepare_browsing_smart": lambda driver, user_id: driver.browse(user_id, "smart"),
+    "prepare_browsing_all": lambda driver, user_id: driver.browse(user_id, "all"),
+    "handle_navigation": lambda driver, user_id: driver.next_profile(user_id),
+    "handle_like": lambda driver, user_id: driver.like(user_id),
+    "handle_toggle": lambda driver, user_id: driver.toggle(user_id),
+    "finish_selection": lambda driver, user_id: driver.finish_selection(user_id),
+    "show_matches": lambda driver, user_id: driver.matches(user_id),
+    "browse_mode": lambda driver, user_id: driver.browse_mode(user_id),
+    "search": lambda driver, user_id: driver.search(user_id),
+    "iter_users": lambda driver, user_id: driver.scan_users()
+}
+
+async def measure(driver, operation, iterations):
+    run = OPERATIONS[operation]
+    users = [driver.random_user() for _ in range(iterations)]
+    # One untimed pass per user primes browsing sessions the same way a real
+    # user would have opened them before tapping Next or Like
+    if operation in ("handle_navigation", "handle_like"):
+        for user_id in set(users):
+            await driver.browse(user_id, "all")
+    # Likewise Back has a buffered toggle to write out
+    if operation == "finish_selection":
+        for user_id in set(users):
+            await driver.toggle(user_id)
+
+    latencies = []
+    started = time.perf_counter()
+    for user_id in users:
+        call_started = time.perf_counter()
+        await run(driver, user_id)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    for user_id in users[:max(1, iterations // 10)]:
+        await run(driver, user_id)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "ops_per_s": iterations / elapsed if elapsed else 0.0,
+        "peak_kib": peak / 1024
+    }
+
+async def run_suite(sizes, operations, iterations, seed):
+    results = {}
+    for size in sizes:
+        driver = HandlerDriver(generate_profiles(size, seed), seed)
+        for operation in operations:
+            result = await measure(driver, operation, iterations)
+            results[f"{operation}@{size}"] = result
+            print(
+                f"{operation:<24} {size:>7} users  "
+                f"p50 {result['p50_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms  "
+                f"p99 {result['p99_ms']:9.3f} ms  {result['ops_per_s']:10.1f} ops/s  "
+                f"peak {result['peak_kib']:10.1f} KiB"
+            )
+        await driver.bot.profile_edits.stop()
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for key, result in results.items():
+        previous = baseline.get(key)
+        if previous and result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{key}: p95 {previous['p95_ms']:.3f} ms -> {result['p95_ms']:.3f} ms")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of AcousticMatchBot handlers against an in-memory store")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated user counts")
+    parser.add_argument("--operations", default=",".join(OPERATIONS), help="comma separated operation names")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="baseline JSON to check for p95 regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown, as a fraction")
+    args = parser.parse_args()
+
+    logging.getLogger("TelegaBot").setLevel(logging.ERROR)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    operations = args.operations.split(",")
+    results = asyncio.run(run_suite(sizes, operations, args.iterations, args.seed))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
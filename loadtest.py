@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from urllib.parse import parse_qs
+
+from telegram import Update
+from telegram.ext import Application
+
+from TelegaBot import (
+    CONCURRENT_UPDATES,
+    INSTRUMENTS,
+    AcousticMatchBot,
+    Database,
+    HttpServer,
+    InstrumentedRequest,
+    PostgresPersistence,
+    TokenBucket,
+    BotApplication,
+    build_application,
+    metrics,
+    percentile
+)
+from benchmark import WORDS, MemoryDatabase, generate_profiles
+
+STUB_TOKEN = "123456:loadtest"
+STUB_METHODS = ("getMe", "sendMessage", "editMessageText", "answerCallbackQuery", "deleteMessage")
+VIRTUAL_USER_BASE = 200000000
+
+completions = {}
+
+class LoadTestApplication(BotApplication):
+    # Resolves the future of each update once every handler group has run,
+    # so latency covers queueing in update_queue as well as processing
+    async def process_update(self, update):
+        try:
+            await super().process_update(update)
+        finally:
+            future = completions.pop(update.update_id, None)
+            if future is not None and not future.done():
+                future.set_result(time.perf_counter())
+
+class StubBotApi:
+    # Answers the Bot API methods the bot calls from a local HttpServer and
+    # remembers the accept buttons each chat was sent, so virtual users can
+    # respond to their collaboration requests.
+    def __init__(self, port=0):
+        self.server = HttpServer(port)
+        self.calls = Counter()
+        self.requests = defaultdict(list)
+        self.last_message = {}
+        self.next_message_id = 1
+        for method in STUB_METHODS:
+            self.server.route("POST", f"/bot{STUB_TOKEN}/{method}", functools.partial(self.handle, method))
+
+    async def start(self):
+        await self.server.start()
+        self.port = self.server.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.server.stop()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def _message(self, chat_id, text):
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        self.last_message[chat_id] = message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text
+        }
+
+    async def handle(self, method, headers, body):
+        self.calls[method] += 1
+        params = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+        chat_id = int(params["chat_id"]) if "chat_id" in params else 0
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif method in ("sendMessage", "editMessageText"):
+            result = self._message(chat_id, params.get("text", ""))
+            markup = json.loads(params.get("reply_markup", "null")) or {}
+            for row in markup.get("inline_keyboard", []):
+                for button in row:
+                    if button.get("callback_data", "").startswith("accept_"):
+                        self.requests[chat_id].append(button["callback_data"].split("_", 1)[1])
+        else:
+            result = True
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+class LoadGenerator:
+    def __init__(self, application, stub, rate, think_time, seed):
+        self.application = application
+        self.stub = stub
+        self.bucket = TokenBucket(rate) if rate > 0 else None
+        self.think_time = think_time
+        self.rng = random.Random(seed)
+        self.next_update_id = 1
+        self.latencies = []
+        self.sent = Counter()
+        self.timeouts = 0
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load{user_id}"}
+
+    def _message_update(self, user_id, text):
+        message = {
+            "message_id": self.next_update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"message": message}
+
+    def _callback_update(self, user_id, data):
+        return {"callback_query": {
+            "id": str(self.next_update_id),
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": self.stub.last_message.get(user_id, 1),
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": ""
+            }
+        }}
+
+    async def send(self, user_id, kind, payload):
+        if self.bucket is not None:
+            while (wait := self.bucket.wait_time()) > 0:
+                await asyncio.sleep(wait)
+            self.bucket.take()
+        update_id = self.next_update_id
+        self.next_update_id += 1
+        update = Update.de_json(dict(payload, update_id=update_id), self.application.bot)
+        future = completions[update_id] = asyncio.get_running_loop().create_future()
+        self.sent[kind] += 1
+        started = time.perf_counter()
+        await self.application.update_queue.put(update)
+        try:
+            finished = await asyncio.wait_for(future, 30)
+        except asyncio.TimeoutError:
+            completions.pop(update_id, None)
+            self.timeouts += 1
+            return
+        self.latencies.append(finished - started)
+        if self.think_time:
+            await asyncio.sleep(self.rng.expovariate(1 / self.think_time))
+
+    async def command(self, user_id, text):
+        await self.send(user_id, text.split()[0], self._message_update(user_id, text))
+
+    async def click(self, user_id, data, kind=None):
+        await self.send(user_id, kind or data, self._callback_update(user_id, data))
+
+    async def edit_profile(self, user_id):
+        await self.click(user_id, "edit_profile")
+        for category in ("instruments", "seeking"):
+            await self.click(user_id, f"edit_{category}")
+            for instrument in self.rng.sample(INSTRUMENTS, self.rng.randint(1, 4)):
+                await self.click(user_id, f"toggle_{category}_{instrument}", "toggle")
+            await self.click(user_id, "back")
+        await self.click(user_id, "back")
+
+    async def browse(self, user_id, steps):
+        await self.click(user_id, "browse_mode")
+        await self.click(user_id, self.rng.choice(("smart", "all")))
+        for _ in range(steps):
+            await self.click(user_id, "like" if self.rng.random() < 0.3 else "next")
+        await self.click(user_id, "back")
+
+    async def search(self, user_id, steps):
+        await self.command(user_id, f"/search {' '.join(self.rng.sample(WORDS + INSTRUMENTS, self.rng.randint(1, 2)))}")
+        for _ in range(steps):
+            await self.click(user_id, "next")
+        await self.click(user_id, "back")
+
+    async def respond(self, user_id):
+        requests, self.stub.requests[user_id] = self.stub.requests[user_id], []
+        for sender_id in requests:
+            action = "accept" if self.rng.random() < 0.7 else "decline"
+            await self.click(user_id, f"{action}_{sender_id}", action)
+
+    async def respond_synthetic(self):
+        # Most likes go to the pre-generated profiles, which have no session
+        # of their own; they answer their requests here instead
+        for chat_id in [chat_id for chat_id in self.stub.requests if chat_id < VIRTUAL_USER_BASE]:
+            await self.respond(chat_id)
+
+    async def answer_remaining(self, notifier, user_ids, timeout=30):
+        # Requests still held back by the notification rate limits when the
+        # sessions ended are delivered and answered before the run stops
+        deadline = time.monotonic() + timeout
+        while notifier.queued_ids and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        await self.respond_synthetic()
+        for user_id in user_ids:
+            await self.respond(user_id)
+
+    async def session(self, user_id, rounds, steps):
+        await self.command(user_id, "/start")
+        await self.edit_profile(user_id)
+        for _ in range(rounds):
+            await self.browse(user_id, steps)
+            if self.rng.random() < 0.3:
+                await self.search(user_id, steps)
+            await self.respond_synthetic()
+            await self.respond(user_id)
+            if self.rng.random() < 0.3:
+                await self.click(user_id, "my_matches")
+        await self.respond(user_id)
+
+def db_query_counts(db):
+    if isinstance(db, MemoryDatabase):
+        return dict(db.calls)
+    return {
+        dict(labels)["method"]: histogram.count
+        for (name, labels), histogram in metrics.histograms.items()
+        if name == "db_query_duration_seconds"
+    }
+
+async def run(args):
+    db = Database() if args.postgres else MemoryDatabase(generate_profiles(args.profiles, args.seed))
+    bot = AcousticMatchBot(db)
+    stub = StubBotApi(args.stub_port)
+    await stub.start()
+
+    errors = Counter()
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    builder = (
+        Application.builder()
+        .token(STUB_TOKEN)
+        .base_url(stub.base_url)
+        .request(InstrumentedRequest(connection_pool_size=256))
+    )
+    # Sessions are persisted as in main(), so every update pays the state
+    # reload and write-through a deployed worker does
+    persistence = PostgresPersistence(db) if args.persistence else None
+    application = build_application(
+        bot, builder, persistence, application_class=LoadTestApplication, concurrency=args.concurrency
+    )
+    application.add_error_handler(count_error)
+    await application.initialize()
+    await application.start()
+    await bot.notifier.start(application.bot)
+
+    generator = LoadGenerator(application, stub, args.rate, args.think_time, args.seed)
+    started = time.perf_counter()
+    user_ids = [VIRTUAL_USER_BASE + i for i in range(args.users)]
+    try:
+        await asyncio.gather(*(generator.session(user_id, args.rounds, args.steps) for user_id in user_ids))
+        # Throughput covers the sessions only, not the wait for rate-limited
+        # notifications before the last answers
+        elapsed = time.perf_counter() - started
+        session_updates = len(generator.latencies)
+        await generator.answer_remaining(bot.notifier, user_ids)
+    finally:
+        await bot.profile_edits.stop()
+        await bot.notifier.stop()
+        await application.stop()
+        await application.shutdown()
+        await stub.stop()
+        if args.postgres:
+            db.close()
+
+    processed = len(generator.latencies)
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "updates": sum(generator.sent.values()),
+        "processed": processed,
+        "timeouts": generator.timeouts,
+        "errors": dict(errors),
+        "error_rate": (sum(errors.values()) + generator.timeouts) / max(1, sum(generator.sent.values())),
+        "elapsed_s": elapsed,
+        "updates_per_s": session_updates / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(generator.latencies, 0.5) * 1000,
+        "p95_ms": percentile(generator.latencies, 0.95) * 1000,
+        "p99_ms": percentile(generator.latencies, 0.99) * 1000,
+        "sent": dict(generator.sent),
+        "bot_api_calls": dict(stub.calls),
+        "db_queries": db_query_counts(db)
+    }
+
+def report(result):
+    print(
+        f"{result['users']} users  concurrency {result['concurrency']}  {result['processed']}/{result['updates']} updates in {result['elapsed_s']:.1f} s  "
+        f"{result['updates_per_s']:.1f} updates/s"
+    )
+    print(f"latency  p50 {result['p50_ms']:.2f} ms  p95 {result['p95_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms")
+    print(f"errors   {result['error_rate']:.2%}  timeouts {result['timeouts']}  {result['errors']}")
+    print(f"db       {sum(result['db_queries'].values())} queries  {result['db_queries']}")
+    print(f"bot api  {sum(result['bot_api_calls'].values())} calls  {result['bot_api_calls']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the bot Application against a local stub Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="concurrent virtual users")
+    parser.add_argument("--rounds", type=int, default=2, help="browse sessions per user")
+    parser.add_argument("--steps", type=int, default=5, help="next/like clicks per browse session")
+    parser.add_argument("--rate", type=float, default=0, help="global update rate limit per second, 0 for unlimited")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENT_UPDATES, help="updates processed in parallel")
+    parser.add_argument("--think-time", type=float, default=0, help="mean pause between a user's updates, in seconds")
+    parser.add_argument("--profiles", type=int, default=10000, help="synthetic profiles in the in-memory store")
+    parser.add_argument("--postgres", action="store_true", help="use DATABASE_URL instead of the in-memory store")
+    parser.add_argument("--no-persistence", dest="persistence", action="store_false", help="keep sessions in memory only")
+    parser.add_argument("--stub-port", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.getLogger("TelegaBot").setLevel(logging.ERROR)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    result = asyncio.run(run(args))
+    report(result)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+    if result["processed"] == 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import asyncio
+import json
+
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, TypeHandler
+
+from TelegaBot import (
+    EDIT_PROFILE,
+    MAIN_MENU,
+    SELECT_INSTRUMENTS,
+    AcousticMatchBot,
+    PostgresPersistence,
+    build_application
+)
+from benchmark import MemoryDatabase, generate_profiles
+from loadtest import STUB_TOKEN, StubBotApi
+
+USER_ID = 300000001
+OTHER_USER_ID = 300000002
+CONVERSATION_KEY = ("conversation:acoustic_match", json.dumps([USER_ID, USER_ID]))
+
+def message(update_id, text, user_id=USER_ID):
+    return {"update_id": update_id, "message": {
+        "message_id": update_id,
+        "date": 0,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        "text": text,
+        "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    }}
+
+def click(update_id, data):
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id),
+        "from": {"id": USER_ID, "is_bot": False, "first_name": "Test"},
+        "chat_instance": str(USER_ID),
+        "data": data,
+        "message": {"message_id": 1, "date": 0, "chat": {"id": USER_ID, "type": "private"}, "text": ""}
+    }}
+
+async def start_worker(db, stub, concurrency):
+    bot = AcousticMatchBot(db)
+    builder = Application.builder().token(STUB_TOKEN).base_url(stub.base_url)
+    application = build_application(bot, builder, PostgresPersistence(db), concurrency=concurrency)
+    await application.initialize()
+    return application
+
+async def process(application, payload):
+    await application.process_update(Update.de_json(payload, application.bot))
+
+async def quick_taps(concurrency, workers):
+    db = MemoryDatabase(generate_profiles(10))
+    stub = StubBotApi()
+    await stub.start()
+    applications = [await start_worker(db, stub, concurrency) for _ in range(workers)]
+    try:
+        # Each tap follows the previous one well inside PERSISTENCE_INTERVAL,
+        # and with several workers lands on a different process every time
+        await process(applications[0], message(1, "/start"))
+        assert json.loads(db.states[CONVERSATION_KEY]) == MAIN_MENU
+        await process(applications[1 % workers], click(2, "edit_profile"))
+        assert json.loads(db.states[CONVERSATION_KEY]) == EDIT_PROFILE
+        await process(applications[2 % workers], click(3, "edit_instruments"))
+        assert json.loads(db.states[CONVERSATION_KEY]) == SELECT_INSTRUMENTS
+        assert stub.calls["editMessageText"] == 2
+    finally:
+        for application in applications:
+            await application.shutdown()
+        await stub.stop()
+
+def test_quick_taps_keep_conversation_state():
+    asyncio.run(quick_taps(concurrency=1, workers=1))
+
+def test_quick_taps_with_concurrent_updates():
+    asyncio.run(quick_taps(concurrency=4, workers=1))
+
+def test_quick_taps_across_workers():
+    asyncio.run(quick_taps(concurrency=1, workers=2))
+
+async def stale_edit_flush(workers):
+    db = MemoryDatabase(generate_profiles(10))
+    stub = StubBotApi()
+    await stub.start()
+    bots = [AcousticMatchBot(db) for _ in range(workers)]
+    applications = []
+    for bot in bots:
+        builder = Application.builder().token(STUB_TOKEN).base_url(stub.base_url)
+        application = build_application(bot, builder, PostgresPersistence(db))
+        await application.initialize()
+        applications.append(application)
+    try:
+        await process(applications[0], message(1, "/start"))
+        await process(applications[0], click(2, "edit_profile"))
+        await process(applications[0], click(3, "edit_instruments"))
+        await process(applications[0], click(4, "toggle_instruments_guitarist"))
+        # The rest of the edit, including Back, lands on the other worker
+        await process(applications[-1], click(5, "toggle_instruments_drummer"))
+        await process(applications[-1], click(6, "back"))
+        expected = (await db.get_user(str(USER_ID)))["instruments"]
+        assert {"guitarist", "drummer"} <= set(expected)
+        # The first worker's flush timer still holds the one-tap buffer
+        task, context = bots[0].profile_edits.flush_tasks.pop(str(USER_ID))
+        task.cancel()
+        await bots[0].profile_edits._flush_detached(str(USER_ID), context)
+        assert (await db.get_user(str(USER_ID)))["instruments"] == expected
+        assert "profile_edit" not in json.loads(db.states[("user_data", str(USER_ID))])
+    finally:
+        for bot, application in zip(bots, applications):
+            await bot.profile_edits.stop()
+            await application.shutdown()
+        await stub.stop()
+
+def test_stale_edit_flush_is_skipped():
+    asyncio.run(stale_edit_flush(workers=2))
+
+async def busy_user_does_not_block_others():
+    stub = StubBotApi()
+    await stub.start()
+    builder = Application.builder().token(STUB_TOKEN).base_url(stub.base_url).updater(None)
+    application = build_application(AcousticMatchBot(MemoryDatabase()), builder, concurrency=2)
+    handled = []
+
+    async def slow_for_busy_user(update, context):
+        handled.append(update.effective_user.id)
+        if update.effective_user.id == USER_ID:
+            await asyncio.sleep(0.05)
+        raise ApplicationHandlerStop
+
+    application.add_handler(TypeHandler(Update, slow_for_busy_user), group=-2)
+    await application.initialize()
+    await application.start()
+    try:
+        # Far more updates than dispatch slots queue up behind one user's lock
+        for update_id in range(1, 21):
+            await application.update_queue.put(Update.de_json(message(update_id, "/start"), application.bot))
+        await application.update_queue.put(Update.de_json(message(21, "/start", OTHER_USER_ID), application.bot))
+        for _ in range(100):
+            if OTHER_USER_ID in handled:
+                break
+            await asyncio.sleep(0.01)
+        assert OTHER_USER_ID in handled
+        assert handled.count(USER_ID) < 5
+    finally:
+        await application.stop()
+        await application.shutdown()
+        await stub.stop()
+
+def test_busy_user_does_not_block_others():
+    asyncio.run(busy_user_does_not_block_others())
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+
+import psycopg2
+import pytest
+from psycopg2.extensions import make_dsn
+
+from TelegaBot import Database, PostgresPersistence
+
+# These tests need a PostgreSQL server the user may create databases on
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL is not set")
+
+CONVERSATION_KEY = ("conversation:acoustic_match", json.dumps([1, 1]))
+USER_KEY = ("user_data", "1")
+
+@pytest.fixture
+def database_url(monkeypatch):
+    # Every test starts from an empty database of its own
+    name = f"acoustic_match_test_{uuid.uuid4().hex}"
+    admin = psycopg2.connect(TEST_DATABASE_URL)
+    admin.autocommit = True
+    with admin.cursor() as cur:
+        cur.execute(f"CREATE DATABASE {name}")
+    url = make_dsn(TEST_DATABASE_URL, dbname=name)
+    monkeypatch.setenv("DATABASE_URL", url)
+    try:
+        yield url
+    finally:
+        with admin.cursor() as cur:
+            cur.execute(f"DROP DATABASE {name} WITH (FORCE)")
+        admin.close()
+
+async def round_trip_states():
+    db = Database()
+    try:
+        assert await db.save_states({CONVERSATION_KEY: 3, USER_KEY: {"browse": {"ids": ["2"]}}})
+        states = await db.load_states([CONVERSATION_KEY, USER_KEY, ("user_data", "2")])
+        assert states == {CONVERSATION_KEY: 3, USER_KEY: {"browse": {"ids": ["2"]}}}
+
+        # None deletes the row; other keys are overwritten in place
+        assert await db.save_states({CONVERSATION_KEY: None, USER_KEY: {"profile_edit": {"instruments": []}}})
+        states = await db.load_states([CONVERSATION_KEY, USER_KEY])
+        assert states == {USER_KEY: {"profile_edit": {"instruments": []}}}
+    finally:
+        db.close()
+
+def test_states_round_trip(database_url):
+    asyncio.run(round_trip_states())
+
+async def flush_waits_for_batch_in_flight():
+    db = Database()
+    persistence = PostgresPersistence(db)
+    try:
+        await persistence.update_user_data(1, {"step": 1})
+        in_flight = asyncio.create_task(persistence._flush())
+        await asyncio.sleep(0)
+        assert persistence.flushing == {USER_KEY: {"step": 1}}
+        # The batch the other caller took is committed before flush returns
+        await persistence.flush()
+        assert in_flight.done()
+        assert persistence.flushing == {} and persistence.pending == {}
+        assert await db.load_states([USER_KEY]) == {USER_KEY: {"step": 1}}
+    finally:
+        db.close()
+
+def test_flush_waits_for_batch_in_flight(database_url):
+    asyncio.run(flush_waits_for_batch_in_flight())
+
+def profile(user_id, instruments, seeking):
+    return {"user_id": user_id, "name": "Test", "username": None, "instruments": instruments, "seeking": seeking, "bio": ""}
+
+async def set_items_refreshes_smart_matches():
+    db = Database()
+    try:
+        guitarist = await db.register_user("1", profile("1", ["guitarist"], ["drummer"]))
+        await db.register_user("2", profile("2", ["pianist"], ["guitarist"]))
+        assert await db.get_smart_match_ids(guitarist) == []
+        # The materialized list picks up the change with the same commit
+        assert await db.set_items("2", {"instruments": ["drummer"]})
+        assert await db.get_smart_match_ids(guitarist) == ["2"]
+    finally:
+        db.close()
+
+def test_set_items_refreshes_smart_matches(database_url):
+    asyncio.run(set_items_refreshes_smart_matches())
+
+async def concurrent_smart_match_rebuilds():
+    db = Database()
+    try:
+        guitarist = await db.register_user("1", profile("1", ["guitarist"], ["drummer"]))
+        await db.register_user("2", profile("2", ["drummer"], ["guitarist"]))
+        first, second = db.pool.getconn(), db.pool.getconn()
+        try:
+            with first.cursor() as cur:
+                db._rebuild_smart_matches(cur, guitarist)
+            # The second rebuild blocks on the first one's rows until it commits
+            loop = asyncio.get_running_loop()
+            blocked = loop.run_in_executor(None, db._rebuild_smart_matches, second.cursor(), guitarist)
+            await asyncio.sleep(0.2)
+            first.commit()
+            await blocked
+            second.commit()
+        finally:
+            db.pool.putconn(first)
+            db.pool.putconn(second)
+        assert await db.get_smart_match_ids(guitarist) == ["2"]
+    finally:
+        db.close()
+
+def test_concurrent_smart_match_rebuilds(database_url):
+    asyncio.run(concurrent_smart_match_rebuilds())
+
+async def migrate_edge_arrays(caplog):
+    db = Database()
+    try:
+        legacy = profile("1", ["guitarist"], ["drummer"])
+        legacy.update({"likes": ["2"], "pending": ["2", "9"], "matches": [], "viewed": ["2", "3"]})
+        await db.register_user("1", legacy)
+        await db.register_user("2", profile("2", ["drummer"], ["guitarist"]))
+        with caplog.at_level(logging.WARNING):
+            db._execute(db._migrate_edges)
+        assert await db.get_edges("1", "like") == ["2"]
+        assert await db.get_edges("1", "pending") == ["2"]
+        assert sorted(await db.get_edges("1", "viewed")) == ["2"]
+        assert "1 pending 9" in caplog.text and "1 viewed 3" in caplog.text
+        # The arrays are gone, so a second run changes nothing
+        db.cache.clear()
+        assert not {"likes", "pending", "matches", "viewed"} & set(await db.get_user("1"))
+        caplog.clear()
+        db._execute(db._migrate_edges)
+        assert caplog.text == ""
+    finally:
+        db.close()
+
+def test_migrate_edge_arrays(database_url, caplog):
+    asyncio.run(migrate_edge_arrays(caplog))
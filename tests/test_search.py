@@ -0,0 +1,33 @@
+import asyncio
+
+from TelegaBot import BROWSE_PROFILES, BROWSE_WINDOW
+from benchmark import FakeUpdate, FakeUser, HandlerDriver, generate_profiles
+
+async def page_past_changed_anchor():
+    profiles = generate_profiles(BROWSE_WINDOW * 3)
+    for profile in profiles:
+        profile["bio"] = "fingerstyle jazz"
+    driver = HandlerDriver(profiles)
+    user_id = profiles[0]["user_id"]
+    context = driver.context(user_id)
+    context.args = ["jazz"]
+    assert await driver.bot.search_command(FakeUpdate(FakeUser(user_id), text="/search jazz"), context) == BROWSE_PROFILES
+    session = context.user_data["browse"]
+    first_page = list(session["ids"])
+    assert len(first_page) == BROWSE_WINDOW
+
+    # The last profile of the page stops matching before the user pages on
+    anchor = driver.db._load(first_page[-1])
+    anchor["bio"] = "folk"
+    driver.db._store(anchor)
+
+    seen = []
+    for _ in range(BROWSE_WINDOW + 1):
+        seen.append(session["profile_id"])
+        state = await driver.bot.handle_navigation(FakeUpdate(FakeUser(user_id), data="next"), context)
+        assert state == BROWSE_PROFILES
+    assert seen == first_page + [session["ids"][0]]
+    assert session["ids"][0] not in first_page
+
+def test_search_pages_past_anchor_that_stopped_matching():
+    asyncio.run(page_past_changed_anchor())